@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+from handlers.idindex import VideoIdIndex
+from handlers.shards import RecordShards
+from os import path
+import json
+import os
+import random
+
+REPO_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+YOUTUBE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+DATE_FORMAT = "%Y-%m-%d"
+
+
+def channel_id(index):
+    return "UC" + "bench%017d" % index
+
+
+def channel_title(index):
+    return "Channel %05d" % index
+
+
+def video_id(channel_index, upload_index, uploads_per_channel):
+    return "v%010d" % (channel_index * uploads_per_channel + upload_index)
+
+
+def write_json(filepath, data):
+    fp = open(filepath, mode='w')
+    json.dump(data, fp=fp, separators=(',', ':'))
+    fp.close()
+
+
+def split_tiers(indices):
+    # f1 and primary are what fetch.py scans by default; everything else only with --all
+    f1_end = max(1, len(indices) // 100)
+    primary_end = f1_end + max(1, len(indices) // 10)
+    secondary_end = primary_end + len(indices) * 3 // 10
+    return {
+        'f1': indices[:f1_end],
+        'primary': indices[f1_end:primary_end],
+        'secondary': indices[primary_end:secondary_end],
+        'waiting': indices[secondary_end:]
+    }
+
+
+def generate(directory, channels=10000, records=100000, playlist_items=5000, uploads_per_channel=11,
+             upload_spacing_hours=24, seed=1):
+    random.seed(seed)
+    config = json.load(open(path.join(REPO_DIR, "config.json"), mode='r'))
+    if not path.exists(path.join(directory, "logs")):
+        os.makedirs(path.join(directory, "logs"))
+
+    epoch = datetime.utcnow().replace(microsecond=0)
+    indices = list(range(channels))
+    tiers = split_tiers(indices)
+    titles = dict((index, channel_title(index)) for index in indices)
+
+    # The last 1% are new subscriptions and another 0.5% were renamed, so refresh_channels has work to do
+    added = set(tiers['waiting'][-(channels // 100):]) if channels >= 100 else set()
+    renamed = set(tiers['waiting'][:channels // 200])
+    filtered = set(tiers['secondary'][:channels // 200])
+    details = {}
+    for index in indices:
+        if index in added:
+            continue
+        title = "Old " + titles[index] if index in renamed else titles[index]
+        details[title] = {
+            'title': title,
+            'id': channel_id(index),
+            'uploads': "UU" + channel_id(index)[2:],
+            'core': channel_id(index)[2:]
+        }
+    write_json(path.join(directory, "subscriptions.json"), {
+        'details': details,
+        'titles': sorted(details),
+        'changes': {},
+        'unsubscribed': []
+    })
+
+    def names(tier):
+        return [("Old " + titles[index] if index in renamed else titles[index]) for index in tiers[tier]
+                if index not in added]
+
+    primary = names('primary')
+    ranks = {
+        'ranks': [
+            {'tier': "f1", 'channels': names('f1')},
+            {'tier': "primary", 'channels': primary[:len(primary) // 2],
+             'subtiers': [{'channels': primary[len(primary) // 2:]}]},
+            {'tier': "secondary", 'channels': names('secondary')},
+            {'tier': "waiting", 'channels': names('waiting')}
+        ],
+        'filters': {
+            'channels': dict((titles[index], channel_id(index)) for index in filtered),
+            'videos': []
+        },
+        'playlist_ids': {},
+        'queues': {
+            'queue': config['QUEUE_ID'],
+            'secondary': config['SECONDARY_QUEUE_ID'],
+            'waiting': config['SECONDARY_QUEUE_ID']
+        },
+        'tiers': {
+            '1': {'A: Primary': names('primary'), 'B: Formula One': names('f1')},
+            '2': names('secondary'),
+            '3': names('waiting')
+        }
+    }
+    write_json(path.join(directory, "ranks.json"), ranks)
+
+    # Everything but each channel's newest upload is already recorded, so a scan queues one per channel
+    dates = {}
+    latest = {}
+    per_channel = max(1, records // max(1, channels))
+    written = 0
+    for index in indices:
+        for upload_index in range(1, min(uploads_per_channel, per_channel + 1)):
+            if written >= records:
+                break
+            published = epoch - timedelta(hours=upload_index * upload_spacing_hours)
+            date = published.strftime(DATE_FORMAT)
+            vid_id = video_id(index, upload_index, uploads_per_channel)
+            if date not in dates:
+                dates[date] = {}
+            if channel_id(index) not in dates[date]:
+                dates[date][channel_id(index)] = {}
+            if upload_index == 1:
+                latest[channel_id(index)] = {'videoId': vid_id, 'publishedAt': published.strftime(YOUTUBE_DATE_FORMAT)}
+            dates[date][channel_id(index)][vid_id] = {
+                'videoId': vid_id,
+                'publishedAt': published.strftime(YOUTUBE_DATE_FORMAT),
+                'channelId': channel_id(index),
+                'channelTitle': titles[index],
+                'title': "Video %s" % vid_id
+            }
+            written += 1
+    dates['previously_added'] = {}
+    store = RecordShards(path.join(directory, config['RECORDS_DIR']), DATE_FORMAT, config['RECORDS_SHARD_FORMAT'])
+    store.dates.update(dates)
+    store.latest.update(latest)
+    store.dirty = set(store.shard_key(date) for date in dates)
+    store.write(store.serialise())
+    VideoIdIndex(path.join(store.directory, "videos.idx"), config['RECORDS_ID_INDEX_MERGE']).build(store.video_ids())
+    write_json(path.join(directory, "private.json"), {'private_videos': []})
+
+    # Sorter playlists are filled from ranked channels so every item has somewhere to go
+    playlists = {}
+    shares = [
+        (config['QUEUE_ID'], 0.2),
+        (config['WATCH_LATER_ID'], 0.3),
+        (config['BACKLOG_ID'], 0.4),
+        (config['F1_PLAYLIST_ID'], 0.1)
+    ]
+    ranked = tiers['f1'] + tiers['primary'] + tiers['secondary']
+    for playlist_id, share in shares:
+        playlists[playlist_id] = []
+        for _ in range(int(playlist_items * share)):
+            index = random.choice(ranked)
+            playlists[playlist_id].append(video_id(index, random.randrange(uploads_per_channel), uploads_per_channel))
+
+    state_filepath = path.join(directory, "fake_state.json")
+    write_json(state_filepath, {
+        'epoch': epoch.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        'channels': [[channel_id(index), titles[index]] for index in indices],
+        'uploads_per_channel': uploads_per_channel,
+        'upload_spacing_hours': upload_spacing_hours,
+        'playlists': playlists
+    })
+
+    return state_filepath
+
+
+def write_config(directory, endpoint):
+    config = json.load(open(path.join(REPO_DIR, "config.json"), mode='r'))
+    config['API_ENDPOINT'] = endpoint
+    config['API_BASE_URL'] = endpoint.rstrip("/") + "/youtube/v3"
+    config['SILENT'] = True
+    # Measure the code, not the safety limits meant for the real API
+    config['QUOTA_DAILY_BUDGET'] = 10 ** 9
+    config['API_RATE_PER_SECOND'] = 10 ** 6
+    config['API_RATE_BURST'] = 10 ** 6
+    fp = open(path.join(directory, "config.json"), mode='w')
+    json.dump(config, fp=fp, separators=(',', ': '), indent=2)
+    fp.close()
@@ -0,0 +1,88 @@
+def parameter(kind="string", required=False, repeated=False):
+    spec = {'type': kind, 'location': "query"}
+    if kind == "integer":
+        spec['format'] = "uint32"
+    if required:
+        spec['required'] = True
+    if repeated:
+        spec['repeated'] = True
+    return spec
+
+
+def method(resource, action, http_method, parameters, required=None, body=None, response=None):
+    spec = {
+        'id': "youtube.%s.%s" % (resource, action),
+        'path': resource,
+        'flatPath': resource,
+        'httpMethod': http_method,
+        'parameters': parameters,
+        'parameterOrder': [] if required is None else required
+    }
+    if body is not None:
+        spec['request'] = {'$ref': body}
+    if response is not None:
+        spec['response'] = {'$ref': response}
+    return spec
+
+
+def document(root_url):
+    # Just the methods this project calls, in the shape googleapiclient.discovery.build expects
+    list_parameters = {
+        'part': parameter(required=True),
+        'id': parameter(),
+        'maxResults': parameter("integer"),
+        'pageToken': parameter()
+    }
+    playlist_item_list = dict(list_parameters, playlistId=parameter(), videoId=parameter())
+    subscription_list = dict(list_parameters, channelId=parameter(), mine=parameter("boolean"), order=parameter())
+    schemas = {}
+    for name in ["PlaylistItem", "PlaylistItemListResponse", "Video", "VideoListResponse",
+                 "SubscriptionListResponse"]:
+        schemas[name] = {'id': name, 'type': "object"}
+
+    return {
+        'kind': "discovery#restDescription",
+        'discoveryVersion': "v1",
+        'id': "youtube:v3",
+        'name': "youtube",
+        'version': "v3",
+        'title': "Local YouTube Data API stand-in",
+        'protocol': "rest",
+        'rootUrl': root_url,
+        'servicePath': "youtube/v3/",
+        'baseUrl': root_url + "youtube/v3/",
+        'batchPath': "batch/youtube/v3",
+        'parameters': {
+            'key': parameter(),
+            'alt': {'type': "string", 'location': "query", 'default': "json", 'enum': ["json"]},
+            'fields': parameter(),
+            'prettyPrint': parameter("boolean")
+        },
+        'schemas': schemas,
+        'resources': {
+            'playlistItems': {
+                'methods': {
+                    'list': method("playlistItems", "list", "GET", playlist_item_list, ["part"],
+                                   response="PlaylistItemListResponse"),
+                    'insert': method("playlistItems", "insert", "POST", {'part': parameter(required=True)},
+                                     ["part"], body="PlaylistItem", response="PlaylistItem"),
+                    'update': method("playlistItems", "update", "PUT", {'part': parameter(required=True)},
+                                     ["part"], body="PlaylistItem", response="PlaylistItem"),
+                    'delete': method("playlistItems", "delete", "DELETE", {'id': parameter(required=True)},
+                                     ["id"])
+                }
+            },
+            'videos': {
+                'methods': {
+                    'list': method("videos", "list", "GET", list_parameters, ["part"],
+                                   response="VideoListResponse")
+                }
+            },
+            'subscriptions': {
+                'methods': {
+                    'list': method("subscriptions", "list", "GET", subscription_list, ["part"],
+                                   response="SubscriptionListResponse")
+                }
+            }
+        }
+    }
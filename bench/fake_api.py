@@ -0,0 +1,352 @@
+from bench import discovery
+from datetime import datetime, timedelta
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import json
+import random
+import threading
+import time
+
+PAGE_SIZE = 5
+MAX_PAGE_SIZE = 50
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class ApiError(Exception):
+    def __init__(self, status, reason, message=""):
+        super().__init__(message or reason)
+        self.status = status
+        self.reason = reason
+
+    def body(self):
+        return {'error': {'code': self.status, 'message': str(self), 'errors': [{'reason': self.reason}]}}
+
+
+class FakeYoutube:
+    # Uploads and video details are derived from the channel and upload index on demand, so
+    # tens of thousands of channels cost no memory; user playlists are held and mutated in memory.
+    def __init__(self, state, error_rate=0.0, seed=None):
+        self.epoch = datetime.strptime(state['epoch'], DATE_FORMAT)
+        self.channels = state['channels']
+        self.channel_index = {}
+        for index, (channel_id, title) in enumerate(self.channels):
+            self.channel_index[channel_id[2:]] = index
+        self.uploads_per_channel = state['uploads_per_channel']
+        self.upload_spacing = timedelta(hours=state['upload_spacing_hours'])
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.playlists = {}
+        self.versions = {}
+        self.item_playlists = {}
+        for playlist_id in state['playlists']:
+            for vid_id in state['playlists'][playlist_id]:
+                self.add_item(playlist_id, vid_id)
+        self.stats = {'http_requests': 0, 'batches': 0, 'not_modified': 0, 'injected_errors': 0, 'methods': {}}
+
+    def add_item(self, playlist_id, vid_id, position=None):
+        self.counter += 1
+        item = {'id': "PI%010d" % self.counter, 'videoId': vid_id}
+        items = self.playlist(playlist_id)
+        items.insert(len(items) if position is None else min(position, len(items)), item)
+        self.item_playlists[item['id']] = playlist_id
+        self.versions[playlist_id] = self.versions.get(playlist_id, 0) + 1
+        return item
+
+    def playlist(self, playlist_id):
+        if playlist_id not in self.playlists:
+            self.playlists[playlist_id] = []
+        return self.playlists[playlist_id]
+
+    def video(self, vid_id):
+        if not vid_id.startswith("v") or not vid_id[1:].isdigit():
+            return None
+        number = int(vid_id[1:])
+        channel, upload = divmod(number, self.uploads_per_channel)
+        if channel >= len(self.channels):
+            return None
+
+        channel_id, title = self.channels[channel]
+        minutes = number * 7919 % 80
+        duration = "PT1H%iM" % (minutes - 60) if minutes >= 60 else "PT%iM%iS" % (minutes, number % 60)
+        return {
+            'kind': "youtube#video",
+            'id': vid_id,
+            'snippet': {
+                'publishedAt': (self.epoch - upload * self.upload_spacing).strftime(DATE_FORMAT),
+                'channelId': channel_id,
+                'channelTitle': title,
+                'title': "Video %s" % vid_id,
+                'liveBroadcastContent': "none"
+            },
+            'contentDetails': {'duration': duration}
+        }
+
+    def count(self, method_id):
+        with self.lock:
+            self.stats['methods'][method_id] = self.stats['methods'].get(method_id, 0) + 1
+
+    def handle(self, method, path, query, headers, body):
+        # Returns (status, extra headers, JSON-able body or None)
+        resource = path.rstrip("/").split("/")[-1]
+        actions = {'GET': "list", 'POST': "insert", 'PUT': "update", 'DELETE': "delete"}
+        method_id = "youtube.%s.%s" % (resource, actions.get(method, "unknown"))
+        self.count(method_id)
+        try:
+            if self.error_rate > 0 and self.random.random() < self.error_rate:
+                with self.lock:
+                    self.stats['injected_errors'] += 1
+                if self.random.random() < 0.5:
+                    raise ApiError(503, "backendError")
+                raise ApiError(403, "rateLimitExceeded")
+            handler = getattr(self, "%s_%s" % (resource, actions.get(method, "unknown")), None)
+            if handler is None:
+                raise ApiError(404, "notFound", "No such method: %s %s" % (method, path))
+            return handler(query, headers, body)
+        except ApiError as e:
+            return e.status, {}, e.body()
+
+    def page(self, items, query):
+        size = min(int(query.get('maxResults', PAGE_SIZE)), MAX_PAGE_SIZE)
+        start = int(query['pageToken'][1:]) if 'pageToken' in query else 0
+        page = {'items': items[start:start + size], 'pageInfo': {'totalResults': len(items), 'resultsPerPage': size}}
+        if start + size < len(items):
+            page['nextPageToken'] = "T%i" % (start + size)
+        return page, start
+
+    def playlistItems_list(self, query, headers, body):
+        playlist_id = query.get('playlistId', "")
+        if playlist_id.startswith("UU") and playlist_id[2:] in self.channel_index:
+            channel = self.channel_index[playlist_id[2:]]
+            ids = [
+                "v%010d" % (channel * self.uploads_per_channel + upload) for upload in range(self.uploads_per_channel)
+            ]
+            entries = [{'id': "UI" + vid_id, 'videoId': vid_id} for vid_id in ids]
+            version = 0
+        else:
+            with self.lock:
+                entries = list(self.playlist(playlist_id))
+                version = self.versions.get(playlist_id, 0)
+
+        page, start = self.page(entries, query)
+        etag = '"%s-%s-%i"' % (playlist_id, start, version)
+        if headers.get('if-none-match') == etag:
+            with self.lock:
+                self.stats['not_modified'] += 1
+            return 304, {'ETag': etag}, None
+
+        items = []
+        for position, entry in enumerate(page['items']):
+            video = self.video(entry['videoId'])
+            item = {
+                'kind': "youtube#playlistItem",
+                'id': entry['id'],
+                'contentDetails': {'videoId': entry['videoId']}
+            }
+            if video is not None:
+                item['contentDetails']['videoPublishedAt'] = video['snippet']['publishedAt']
+            if 'snippet' in query.get('part', ""):
+                item['snippet'] = {
+                    'playlistId': playlist_id,
+                    'position': start + position,
+                    'resourceId': {'kind': "youtube#video", 'videoId': entry['videoId']},
+                    'title': video['snippet']['title'] if video is not None else "Private video",
+                    'channelId': video['snippet']['channelId'] if video is not None else "",
+                    'channelTitle': video['snippet']['channelTitle'] if video is not None else "",
+                    'publishedAt': video['snippet']['publishedAt'] if video is not None else ""
+                }
+            items.append(item)
+        page['items'] = items
+        page['kind'] = "youtube#playlistItemListResponse"
+        page['etag'] = etag
+        return 200, {'ETag': etag}, page
+
+    def playlistItems_insert(self, query, headers, body):
+        snippet = body['snippet']
+        with self.lock:
+            item = self.add_item(snippet['playlistId'], snippet['resourceId']['videoId'], snippet.get('position'))
+        return 200, {}, {'kind': "youtube#playlistItem", 'id': item['id'], 'snippet': snippet}
+
+    def playlistItems_update(self, query, headers, body):
+        snippet = body['snippet']
+        with self.lock:
+            if body.get('id') not in self.item_playlists:
+                raise ApiError(404, "playlistItemNotFound")
+            items = self.playlist(self.item_playlists[body['id']])
+            item = [entry for entry in items if entry['id'] == body['id']][0]
+            items.remove(item)
+            position = snippet.get('position')
+            items.insert(len(items) if position is None else min(position, len(items)), item)
+            self.versions[snippet['playlistId']] = self.versions.get(snippet['playlistId'], 0) + 1
+        return 200, {}, {'kind': "youtube#playlistItem", 'id': item['id'], 'snippet': snippet}
+
+    def playlistItems_delete(self, query, headers, body):
+        item_id = query.get('id')
+        with self.lock:
+            if item_id not in self.item_playlists:
+                raise ApiError(404, "playlistItemNotFound")
+            playlist_id = self.item_playlists.pop(item_id)
+            items = self.playlist(playlist_id)
+            items[:] = [entry for entry in items if entry['id'] != item_id]
+            self.versions[playlist_id] = self.versions.get(playlist_id, 0) + 1
+        return 204, {}, None
+
+    def videos_list(self, query, headers, body):
+        # As the real API: maxResults only goes with myRating or chart, never with id
+        if 'id' in query and 'maxResults' in query:
+            raise ApiError(400, "unexpectedParameter", "maxResults cannot be used with id")
+        items = []
+        for vid_id in query.get('id', "").split(","):
+            video = self.video(vid_id) if vid_id else None
+            if video is not None:
+                items.append(video)
+        return 200, {}, {'kind': "youtube#videoListResponse", 'items': items}
+
+    def subscriptions_list(self, query, headers, body):
+        subscriptions = sorted(self.channels, key=lambda channel: channel[1])
+        page, start = self.page(subscriptions, query)
+        page['items'] = [
+            {
+                'kind': "youtube#subscription",
+                'snippet': {'title': title, 'resourceId': {'kind': "youtube#channel", 'channelId': channel_id}}
+            }
+            for channel_id, title in page['items']
+        ]
+        return 200, {}, page
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def do_DELETE(self):
+        self.dispatch()
+
+    def dispatch(self):
+        api = self.server.api
+        length = int(self.headers['Content-Length']) if 'Content-Length' in self.headers else 0
+        body = self.rfile.read(length) if length > 0 else b""
+        parts = urlsplit(self.path)
+        if parts.path == "/_stats":
+            with api.lock:
+                return self.respond(200, {}, json.loads(json.dumps(api.stats)))
+        if parts.path.startswith("/discovery/"):
+            root_url = "http://%s/" % self.headers['Host']
+            return self.respond(200, {}, discovery.document(root_url))
+
+        with api.lock:
+            api.stats['http_requests'] += 1
+            if 'first_request' not in api.stats:
+                api.stats['first_request'] = time.time()
+        if self.server.latency > 0 or self.server.jitter > 0:
+            time.sleep(max(0, self.server.latency + random.uniform(-self.server.jitter, self.server.jitter)))
+        if parts.path.startswith("/batch/"):
+            with api.lock:
+                api.stats['batches'] += 1
+            return self.batch(body)
+
+        status, headers, content = api.handle(self.command, parts.path, query_dict(parts.query),
+                                              lower_headers(self.headers.items()),
+                                              json.loads(body.decode('utf-8')) if body else None)
+        self.respond(status, headers, content)
+
+    def respond(self, status, headers, content, content_type="application/json; charset=UTF-8"):
+        data = json.dumps(content).encode('utf-8') if content is not None else b""
+        self.send_response(status)
+        for name in headers:
+            self.send_header(name, headers[name])
+        if content is not None:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def batch(self, body):
+        # multipart/mixed in, multipart/mixed out, one application/http part per request
+        message = BytesParser().parsebytes(
+            b"Content-Type: " + self.headers['Content-Type'].encode('latin-1') + b"\r\n\r\n" + body)
+        boundary = "batch_%016x" % random.getrandbits(64)
+        chunks = []
+        for part in message.get_payload():
+            content_id = part['Content-ID'].strip("<>")
+            request = part.get_payload(decode=True)
+            head, _, sub_body = request.replace(b"\r\n", b"\n").partition(b"\n\n")
+            lines = head.decode('utf-8').split("\n")
+            method, target = lines[0].split(" ")[:2]
+            sub_headers = lower_headers(line.split(":", 1) for line in lines[1:] if ":" in line)
+            target_parts = urlsplit(target)
+            status, headers, content = self.server.api.handle(
+                method, target_parts.path, query_dict(target_parts.query), sub_headers,
+                json.loads(sub_body.decode('utf-8')) if sub_body.strip() else None)
+            data = json.dumps(content) if content is not None else ""
+            chunks.append(
+                "--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n"
+                "HTTP/1.1 %i %s\r\nContent-Type: application/json; charset=UTF-8\r\nContent-Length: %i\r\n\r\n%s\r\n"
+                % (boundary, content_id, status, self.responses.get(status, ("",))[0], len(data.encode('utf-8')),
+                   data))
+        chunks.append("--%s--\r\n" % boundary)
+        data = "".join(chunks).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', "multipart/mixed; boundary=%s" % boundary)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def query_dict(query):
+    return dict((key, values[-1]) for key, values in parse_qs(query).items())
+
+
+def lower_headers(pairs):
+    return dict((name.strip().lower(), value.strip()) for name, value in pairs)
+
+
+class FakeApiServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api, latency=0.0, jitter=0.0):
+        super().__init__(address, RequestHandler)
+        self.api = api
+        self.latency = latency
+        self.jitter = jitter
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the YouTube Data API endpoints this project uses')
+    parser.add_argument('--state', required=True, help="State file written by bench.data.generate")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Added to every HTTP request")
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of calls answered with backendError or rateLimitExceeded")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    api = FakeYoutube(json.load(open(args.state, mode='r')), error_rate=args.error_rate, seed=args.seed)
+    server = FakeApiServer((args.host, args.port), api, args.latency_ms / 1000, args.jitter_ms / 1000)
+    print("Listening on http://%s:%i/" % server.server_address, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
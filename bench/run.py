@@ -0,0 +1,140 @@
+from bench import data
+from os import path
+from time import monotonic
+from urllib.request import urlopen
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+
+TARGETS = {
+    'fetch': ["fetch.py"],
+    'fetch-asyncio': ["fetch.py", "--asyncio"],
+    'fetch-all': ["fetch.py", "--all"],
+    'refresh': ["refresh_channels.py"],
+    'sort': ["sorter.py"]
+}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_stats(endpoint):
+    return json.loads(urlopen(endpoint + "_stats").read().decode('utf-8'))
+
+
+def start_server(state_filepath, port, args):
+    command = [
+        sys.executable, "-m", "bench.fake_api", "--state", state_filepath, "--port", str(port),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+        "--error-rate", str(args.error_rate), "--seed", str(args.seed)
+    ]
+    server = subprocess.Popen(command, cwd=data.REPO_DIR, stdout=subprocess.PIPE)
+    server.stdout.readline()
+
+    return server
+
+
+def run_target(name, template, workdir, args):
+    # Every target gets a fresh copy of the data and a fresh server, so each run starts cold
+    directory = path.join(workdir, name)
+    if path.exists(directory):
+        shutil.rmtree(directory)
+    shutil.copytree(template, directory)
+    port = free_port()
+    endpoint = "http://127.0.0.1:%i/" % port
+    data.write_config(directory, endpoint)
+    server = start_server(path.join(directory, "fake_state.json"), port, args)
+    try:
+        before = get_stats(endpoint)
+        env = dict(os.environ, PYTHONPATH=data.REPO_DIR)
+        output = open(path.join(directory, "output.log"), mode='w')
+        started = monotonic()
+        process = subprocess.Popen([sys.executable] + [path.join(data.REPO_DIR, TARGETS[name][0])] + TARGETS[name][1:],
+                                   cwd=directory, env=env, stdout=output, stderr=subprocess.STDOUT)
+        # wait4 reports the peak RSS of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = monotonic() - started
+        output.close()
+        after = get_stats(endpoint)
+    finally:
+        server.terminate()
+        server.wait()
+
+    methods = {}
+    for method_id in after['methods']:
+        count = after['methods'][method_id] - before['methods'].get(method_id, 0)
+        if count > 0:
+            methods[method_id] = count
+
+    return {
+        'target': name,
+        'exit_code': os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8,
+        'wall_seconds': round(elapsed, 3),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1) if sys.platform != 'darwin' else round(
+            usage.ru_maxrss / 1024 / 1024, 1),
+        'http_requests': after['http_requests'] - before['http_requests'],
+        'api_calls': sum(methods.values()),
+        'batches': after['batches'] - before['batches'],
+        'not_modified': after['not_modified'] - before['not_modified'],
+        'injected_errors': after['injected_errors'] - before['injected_errors'],
+        'methods': methods
+    }
+
+
+def print_report(results):
+    columns = ["target", "exit_code", "wall_seconds", "peak_rss_mb", "http_requests", "api_calls", "not_modified"]
+    rows = [columns] + [[str(result[column]) for column in columns] for result in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(widths[i]) for i, value in enumerate(row)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark against the local fake YouTube API')
+    parser.add_argument('--workdir', default="bench_run")
+    parser.add_argument('--targets', default="fetch,fetch-asyncio,refresh,sort",
+                        help="Comma-separated: %s" % ", ".join(sorted(TARGETS)))
+    parser.add_argument('--channels', type=int, default=10000)
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--playlist-items', type=int, default=5000)
+    parser.add_argument('--uploads-per-channel', type=int, default=11)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    workdir = path.abspath(args.workdir)
+    template = path.join(workdir, "template")
+    if path.exists(template):
+        shutil.rmtree(template)
+    os.makedirs(template)
+    data.generate(template, channels=args.channels, records=args.records, playlist_items=args.playlist_items,
+                  uploads_per_channel=args.uploads_per_channel, seed=args.seed)
+
+    results = []
+    for name in args.targets.split(","):
+        result = run_target(name.strip(), template, workdir, args)
+        print("%s: exit %i in %.1fs" % (result['target'], result['exit_code'], result['wall_seconds']), flush=True)
+        results.append(result)
+
+    print()
+    print_report(results)
+    if args.output is not None:
+        fp = open(args.output, mode='w')
+        json.dump(results, fp=fp, separators=(',', ': '), indent=2)
+        fp.close()
+
+
+if __name__ == '__main__':
+    main()
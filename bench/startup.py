@@ -0,0 +1,105 @@
+from bench import data, run
+from os import path
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules whose import alone should stay cheap; update_credentials.py is left out as it
+# authenticates at import time
+MODULES = ["fetch", "sorter", "refresh_channels", "daemon"]
+
+
+def import_ms(module, directory):
+    # -X importtime reports cumulative microseconds per module; the target is the last top-level line
+    env = dict(os.environ, PYTHONPATH=data.REPO_DIR)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module], cwd=directory,
+                             env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in reversed(process.stderr.splitlines()):
+        fields = [field.strip() for field in line.split("|")]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError("No import time for %s: %s" % (module, process.stderr[-500:]))
+
+
+def first_request_ms(directory, port, args):
+    # From spawning fetch.py to the fake API seeing its first request, on a fresh server
+    endpoint = "http://127.0.0.1:%i/" % port
+    server = run.start_server(path.join(directory, "fake_state.json"), port, args)
+    try:
+        env = dict(os.environ, PYTHONPATH=data.REPO_DIR)
+        started = time.time()
+        process = subprocess.Popen([sys.executable, path.join(data.REPO_DIR, "fetch.py")], cwd=directory, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        process.wait()
+        stats = run.get_stats(endpoint)
+    finally:
+        server.terminate()
+        server.wait()
+    if process.returncode != 0 or 'first_request' not in stats:
+        raise RuntimeError("fetch.py exited with %i before any request" % process.returncode)
+
+    return (stats['first_request'] - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup budget: module import times and time to first API request')
+    parser.add_argument('--workdir', default="bench_startup")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--import-budget-ms', type=float, default=150.0)
+    parser.add_argument('--first-request-budget-ms', type=float, default=750.0)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="Also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    directory = path.abspath(args.workdir)
+    if path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    data.generate(directory, channels=args.channels, records=args.channels * 10, playlist_items=100, seed=args.seed)
+    # One port for every run, so the discovery document cached by the first run stays valid
+    port = run.free_port()
+    data.write_config(directory, "http://127.0.0.1:%i/" % port)
+
+    results = {'imports': {}, 'first_request': {}}
+    for module in MODULES:
+        results['imports'][module] = round(min(import_ms(module, directory) for _ in range(args.runs)), 1)
+    cold = first_request_ms(directory, port, args)
+    warm = [first_request_ms(directory, port, args) for _ in range(args.runs)]
+    results['first_request'] = {
+        'cold_ms': round(cold, 1),
+        'warm_median_ms': round(statistics.median(warm), 1),
+        'warm_max_ms': round(max(warm), 1)
+    }
+
+    failures = []
+    for module in MODULES:
+        print("import %-18s %8.1f ms" % (module, results['imports'][module]))
+        if results['imports'][module] > args.import_budget_ms:
+            failures.append("import %s: %.1f ms > %.1f ms" % (module, results['imports'][module],
+                                                               args.import_budget_ms))
+    print("first request, cold    %8.1f ms" % results['first_request']['cold_ms'])
+    print("first request, warm    %8.1f ms (median of %i)" % (results['first_request']['warm_median_ms'], args.runs))
+    if results['first_request']['warm_median_ms'] > args.first_request_budget_ms:
+        failures.append("first request: %.1f ms > %.1f ms" % (results['first_request']['warm_median_ms'],
+                                                              args.first_request_budget_ms))
+
+    if args.output is not None:
+        fp = open(args.output, mode='w')
+        json.dump(results, fp=fp, separators=(',', ': '), indent=2)
+        fp.close()
+    for failure in failures:
+        print("Over budget: %s" % failure)
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
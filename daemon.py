@@ -0,0 +1,137 @@
+from handlers import cache, metrics, playlist, quota, triggers
+from handlers.utilities import ConfigHandler, Logger
+from os import path
+from time import monotonic, process_time
+import argparse
+import os
+import fetch
+import refresh_channels
+import sorter
+
+logger = Logger()
+
+# Trigger file -> job, checked in this order; each also fires as <name>.txt
+JOBS = ['check', 'import_queue', 'refresh_channels']
+
+
+def run_check():
+    fetch.run(fetch.parse_args([]))
+
+
+def run_import_queue():
+    sorter.main()
+
+
+def run_refresh_channels():
+    refresh_channels.fetch({'verbose': False})
+
+
+RUNNERS = {
+    'check': run_check,
+    'import_queue': run_import_queue,
+    'refresh_channels': run_refresh_channels
+}
+
+
+class TriggerDaemon:
+    # Replaces the check/sort/refresh shell loops: one resident process waits on the trigger
+    # files and runs the jobs in-process, so clients, config and indexes stay loaded between runs
+    def __init__(self):
+        config = ConfigHandler()
+        self.home = config.home
+        self.directories = [self.home]
+        for directory in config.variables['TRIGGER_DIRS']:
+            directory = path.abspath(path.expanduser(directory))
+            if directory not in self.directories and path.isdir(directory):
+                self.directories.append(directory)
+        self.active_filepath = path.join(self.home, 'active')
+        self.poll_interval = config.variables['TRIGGER_POLL_INTERVAL']
+        self.rescan_interval = config.variables['TRIGGER_RESCAN_INTERVAL']
+        self.names = [name + suffix for name in JOBS for suffix in ["", ".txt"]]
+        self.watcher = None
+
+    def trigger_paths(self, job):
+        return [path.join(directory, job + suffix) for directory in self.directories for suffix in ["", ".txt"]
+                if path.exists(path.join(directory, job + suffix))]
+
+    def next_job(self):
+        if path.exists(self.active_filepath):
+            # A run started outside the daemon still holds the lock
+            return None
+        for job in JOBS:
+            if len(self.trigger_paths(job)) > 0:
+                return job
+        return None
+
+    def run_job(self, job):
+        logger.write("Trigger: %s" % job)
+        started = monotonic()
+        cpu_started = process_time()
+        open(self.active_filepath, mode='w').close()
+        metrics.get_metrics().start(job)
+        # Other processes may have written records or ETags since the last job
+        playlist.revalidate_records()
+        cache.revalidate_response_cache()
+        try:
+            RUNNERS[job]()
+        except Exception as e:
+            logger.write("Job failed: %s: %s" % (job, repr(e)))
+        finally:
+            # Triggers are cleared even after a failure, as the shell loops did, so a bad run is not retried forever
+            for filepath in self.trigger_paths(job):
+                logger.write("Removing %s" % filepath)
+                os.remove(filepath)
+            if job == 'import_queue':
+                self.requeue_sort()
+            quota.get_ledger().flush()
+            metrics.get_metrics().write()
+            metrics.get_metrics().start("daemon")
+            os.remove(self.active_filepath)
+        logger.write("Finished %s in %.1fs (%.1fs CPU)" % (job, monotonic() - started, process_time() - cpu_started))
+
+    def requeue_sort(self):
+        for directory in self.directories:
+            sort_again_filepath = path.join(directory, 'sort_again')
+            if path.exists(sort_again_filepath):
+                logger.write("Sorting again")
+                os.replace(sort_again_filepath, path.join(directory, 'import_queue'))
+
+    def run(self, once=False):
+        self.watcher = triggers.get_watcher(self.directories, self.names, self.poll_interval)
+        logger.write("Watching %s" % ", ".join(self.directories))
+        try:
+            while True:
+                job = self.next_job()
+                while job is not None:
+                    self.run_job(job)
+                    job = self.next_job()
+                if once:
+                    return
+                # The timeout is a backstop for missed events, e.g. the active lock being released elsewhere
+                self.watcher.wait(self.rescan_interval)
+        finally:
+            self.watcher.close()
+
+
+def main():
+    flags = {
+        "once": {
+            "shorthand": "o",
+            "help": "Run whatever is triggered now and exit instead of waiting for more"
+        }
+    }
+
+    parser = argparse.ArgumentParser(description='Run fetch, sort and refresh in one resident process on triggers')
+
+    for flag in sorted(flags):
+        dest_var = flag
+        shorthand = flags[flag]['shorthand']
+        help_text = flags[flag]['help']
+        parser.add_argument('-' + shorthand, '--' + dest_var, dest=dest_var, action='store_true', help=help_text)
+
+    args = vars(parser.parse_args())
+    TriggerDaemon().run(once=args['once'])
+
+
+if __name__ == '__main__':
+    main()
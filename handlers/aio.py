@@ -0,0 +1,353 @@
+from handlers import client, execution, metrics, quota, videos
+from handlers.playlist import SubscribedChannel
+from handlers.utilities import ConfigHandler, Logger
+from time import monotonic
+from urllib.parse import urlencode, urlsplit
+import asyncio
+import json
+import ssl
+
+logger = Logger()
+
+
+class AsyncHttpError(Exception):
+    def __init__(self, status, content, headers=None):
+        super().__init__("HTTP %i: %s" % (status, content[:200]))
+        self.status = status
+        self.content = content
+        self.headers = headers
+
+
+class AsyncHttpClient:
+    # Minimal HTTP/1.1 client on asyncio streams with keep-alive connection reuse
+    def __init__(self, timeout=None):
+        self.idle = {}
+        self.timeout = timeout
+
+    async def connect(self, scheme, host, port):
+        ssl_context = ssl.create_default_context() if scheme == 'https' else None
+
+        return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl_context), self.timeout)
+
+    async def request(self, method, url, headers=None, body=None):
+        parts = urlsplit(url)
+        port = parts.port if parts.port is not None else (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % parts.netloc, "Accept: application/json"]
+        if headers is not None:
+            for name in headers:
+                lines.append("%s: %s" % (name, headers[name]))
+        payload = b"" if body is None else body
+        lines.append("Content-Length: %i" % len(payload))
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + payload
+
+        while True:
+            reused = key in self.idle and len(self.idle[key]) > 0
+            reader, writer = self.idle[key].pop() if reused else await self.connect(*key)
+            try:
+                status, response_headers, content, keep_alive = await asyncio.wait_for(
+                    self.exchange(reader, writer, message), self.timeout)
+            except asyncio.TimeoutError:
+                # A stalled or half-open connection is dropped, never returned to the idle pool
+                writer.close()
+                raise
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # The server closed an idle keep-alive connection; retry on a fresh one
+                    continue
+                raise
+
+            if keep_alive:
+                if key not in self.idle:
+                    self.idle[key] = []
+                self.idle[key].append((reader, writer))
+            else:
+                writer.close()
+
+            return status, response_headers, content
+
+    async def exchange(self, reader, writer, message):
+        writer.write(message)
+        await writer.drain()
+
+        return await self.read_response(reader)
+
+    async def read_response(self, reader):
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("Connection closed before a response was received")
+        version, status = status_line.split()[:2]
+        status = int(status)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers['connection'].lower() if 'connection' in headers else ""
+        keep_alive = version == b"HTTP/1.1" and connection != "close"
+        if status in (204, 304) or status < 200:
+            content = b""
+        elif 'transfer-encoding' in headers and headers['transfer-encoding'].lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b"".join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        return status, headers, content, keep_alive
+
+    def close(self):
+        for key in self.idle:
+            for reader, writer in self.idle[key]:
+                writer.close()
+        self.idle = {}
+
+
+class AsyncYoutubeClient:
+    def __init__(self, http, base_url, credentials=None):
+        self.http = http
+        self.base_url = base_url.rstrip("/")
+        self.credentials = credentials
+        self.lock = asyncio.Lock()
+
+    async def authorization(self):
+        async with self.lock:
+            if not self.credentials.valid:
+                from google.auth.transport.requests import Request
+
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self.credentials.refresh, Request())
+
+        return "Bearer %s" % self.credentials.token
+
+    async def call(self, method, resource, action, params, body=None, headers=None, priority=quota.NORMAL):
+        quota.get_ledger().charge(["youtube.%s.%s" % (resource, action)], priority)
+        url = "%s/%s?%s" % (self.base_url, resource, urlencode(params))
+
+        request_headers = {} if headers is None else dict(headers)
+        if self.credentials is not None:
+            request_headers['Authorization'] = await self.authorization()
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            request_headers['Content-Type'] = "application/json"
+
+        status, response_headers, content = await self.http.request(method, url, request_headers, data)
+        if status < 300:
+            metrics.get_metrics().add_bytes("youtube.%s.%s" % (resource, action), len(content))
+        if status >= 300:
+            raise AsyncHttpError(status, content, response_headers)
+
+        return json.loads(content.decode('utf-8')) if content else {}
+
+
+class AsyncScanner:
+    def __init__(self, pickle=None):
+        config = ConfigHandler()
+        self.base_url = config.variables['API_BASE_URL']
+        self.channel_concurrency = config.variables['ASYNC_SCAN_CONCURRENCY']
+        self.request_concurrency = config.variables['ASYNC_REQUEST_CONCURRENCY']
+        self.request_timeout = config.variables['ASYNC_REQUEST_TIMEOUT']
+        self.pickle = "token.pickle" if pickle is None else pickle
+        self.secrets_filepath = config.secrets_filepath
+        self.scopes = config.variables['SCOPES']
+        self.anonymous = bool(config.variables['API_ENDPOINT'])
+        self.youtube = None
+        self.requests = None
+        self.errors = []
+
+    def run(self, scanners):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.scan(scanners))
+        finally:
+            loop.close()
+
+        return self.errors
+
+    def get_credentials(self):
+        if self.anonymous:
+            return None
+        return client.pool.get_credentials(self.pickle, self.secrets_filepath, list(self.scopes))
+
+    async def scan(self, scanners):
+        loop = asyncio.get_event_loop()
+        credentials = await loop.run_in_executor(None, self.get_credentials)
+        self.youtube = AsyncYoutubeClient(AsyncHttpClient(self.request_timeout), self.base_url, credentials)
+        self.requests = asyncio.Semaphore(self.request_concurrency)
+
+        # A fixed set of worker coroutines keeps memory flat however many channels there are
+        pending = asyncio.Queue()
+        for scanner in scanners:
+            pending.put_nowait(scanner)
+        channel_workers = [
+            asyncio.ensure_future(self.worker(pending)) for _ in range(min(self.channel_concurrency, len(scanners)))
+        ]
+        if len(channel_workers) > 0:
+            await asyncio.gather(*channel_workers)
+        self.youtube.http.close()
+
+    async def worker(self, pending):
+        while not pending.empty():
+            scanner = pending.get_nowait()
+            try:
+                await self.scan_channel(scanner)
+            except Exception as e:
+                logger.write("Scan failed: %s: %s" % (scanner.name, repr(e)))
+                self.errors.append(e)
+
+    async def call(self, method, resource, action, params, body=None, headers=None, priority=quota.NORMAL):
+        # Shares the rate limiter, retry policy and circuit breaker of execution.execute
+        executor = execution.get_executor()
+        recorder = metrics.get_metrics()
+        ids = ["youtube.%s.%s" % (resource, action)]
+        attempt = 0
+        elapsed = 0.0
+        waited = 0.0
+        while True:
+            started = monotonic()
+            await asyncio.sleep(executor.breaker.wait_time())
+            await asyncio.sleep(executor.bucket.reserve())
+            try:
+                async with self.requests:
+                    sent = monotonic()
+                    waited += sent - started
+                    response = await self.youtube.call(method, resource, action, params, body, headers, priority)
+            except AsyncHttpError as e:
+                elapsed += monotonic() - sent
+                reason = execution.retry_reason(e.status, e.content)
+                if reason is None:
+                    executor.breaker.record_success()
+                    recorder.record(ids, elapsed, attempt, e.status, waited)
+                    raise
+                delay = executor.retry_delay(ids, attempt, reason, execution.retry_after(e.headers))
+                if delay is None:
+                    recorder.record(ids, elapsed, attempt, e.status, waited)
+                    raise
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                elapsed += monotonic() - sent
+                delay = executor.retry_delay(ids, attempt, repr(e))
+                if delay is None:
+                    recorder.record(ids, elapsed, attempt, metrics.NO_RESPONSE, waited)
+                    raise
+            else:
+                elapsed += monotonic() - sent
+                executor.breaker.record_success()
+                recorder.record(ids, elapsed, attempt, 200, waited)
+                return response
+
+            await asyncio.sleep(delay)
+            waited += delay
+            attempt += 1
+
+    async def scan_channel(self, scanner):
+        logger.write("Starting scan: %s" % scanner.name)
+        channel = SubscribedChannel(**scanner.channel_kwargs)
+        scanner.channel = channel
+        horizon = channel.upload_horizon()
+
+        response = await self.uploads_page(channel)
+        items = list(response['items'])
+        pages = 1
+        while scanner.all and 'nextPageToken' in response and not channel.crosses(response['items'], horizon):
+            response = await self.uploads_page(channel, page_token=response['nextPageToken'])
+            items += response['items']
+            pages += 1
+        logger.write("Pages of videos for %s: %i" % (channel.name, pages))
+
+        results = []
+        failed = None
+        page_lists = channel.detail_pages(items)
+        found_pages = await asyncio.gather(*[self.details(channel, page_list) for page_list in page_lists],
+                                           return_exceptions=True)
+        for page_num, found in enumerate(found_pages):
+            if isinstance(found, BaseException):
+                logger.write("Failed to get details: %s Page %i (%i videos): %s" % (
+                    channel.name, page_num, len(page_lists[page_num]), repr(found)))
+                failed = found
+            else:
+                results += found
+        channel.set_newest(results)
+
+        # The pages that did download are still queued; a failed page's videos stay unrecorded,
+        # so the next scan picks them up again
+        for vid_data in channel.newest:
+            if scanner.should_queue(vid_data):
+                try:
+                    response = await self.add_video_to_queue(scanner, vid_data)
+                except (quota.QuotaDeferred, quota.QuotaExhausted) as e:
+                    logger.write("Stopped queuing %s: %s" % (scanner.name, e))
+                    break
+                if response is not None:
+                    scanner.added_to_queue.append(vid_data)
+        if failed is not None:
+            raise failed
+
+    async def uploads_page(self, channel, page_token=None):
+        params = {
+            'part': "contentDetails",
+            'maxResults': 50,
+            'playlistId': channel.playlist_id
+        }
+        if page_token is not None:
+            params['pageToken'] = page_token
+
+        cached = channel.response_cache.get(channel.playlist_id, page_token)
+        headers = {'If-None-Match': cached['etag']} if cached is not None else None
+        try:
+            response = await self.call('GET', 'playlistItems', 'list', params, headers=headers,
+                                       priority=channel.priority)
+        except AsyncHttpError as e:
+            if cached is not None and e.status == 304:
+                return cached
+            raise
+
+        channel.unchanged = False
+        channel.response_cache.put(channel.playlist_id, page_token, response)
+
+        return response
+
+    async def details(self, channel, page_list):
+        video_cache = videos.get_video_cache()
+        found = video_cache.get_many(page_list)
+        missing = [vid_id for vid_id in page_list if vid_id not in found]
+        if len(missing) > 0:
+            params = {
+                'part': "snippet,contentDetails",
+                'id': ",".join(missing)
+            }
+            response = await self.call('GET', 'videos', 'list', params, priority=channel.priority)
+            video_cache.store(missing, response['items'], found)
+
+        return [found[vid_id] for vid_id in page_list if vid_id in found]
+
+    async def add_video_to_queue(self, scanner, vid_data):
+        logger.write("Adding to queue: %s - %s" % (vid_data['snippet']['channelTitle'], vid_data['snippet']['title']))
+        try:
+            response = await self.call('POST', 'playlistItems', 'insert', {'part': "snippet"},
+                                       body=scanner.queue_body(vid_data), priority=scanner.priority)
+        except AsyncHttpError as e:
+            logger.write("Failed to add to queue: %s - %s: %s" % (
+                vid_data['snippet']['channelTitle'], vid_data['snippet']['title'], e))
+            return None
+        scanner.records.add_record(vid_data=vid_data)
+
+        return response
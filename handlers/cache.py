@@ -0,0 +1,76 @@
+from handlers.utilities import ConfigHandler, Logger, file_versions
+import json
+import os
+import threading
+
+logger = Logger()
+
+
+class ResponseCache:
+    def __init__(self):
+        config = ConfigHandler()
+        self.filepath = config.etag_cache_filepath
+        self.lock = threading.Lock()
+        self.data = json.load(open(self.filepath, mode='r')) if os.path.exists(self.filepath) else {}
+        self.dirty = False
+        self.seen = file_versions([self.filepath])
+
+    def page_key(self, page_token):
+        return "" if page_token is None else page_token
+
+    def get(self, playlist_id, page_token=None):
+        pages = self.data[playlist_id] if playlist_id in self.data else {}
+        key = self.page_key(page_token)
+
+        return pages[key] if key in pages else None
+
+    def put(self, playlist_id, page_token, response):
+        entry = {
+            'etag': response['etag'],
+            'items': [{'contentDetails': item['contentDetails']} for item in response['items']]
+        }
+        if 'nextPageToken' in response:
+            entry['nextPageToken'] = response['nextPageToken']
+
+        with self.lock:
+            if playlist_id not in self.data:
+                self.data[playlist_id] = {}
+            self.data[playlist_id][self.page_key(page_token)] = entry
+            self.dirty = True
+
+    def write(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_filepath = self.filepath + ".tmp"
+            fp = open(tmp_filepath, mode='w')
+            json.dump(self.data, fp=fp, separators=(',', ':'))
+            fp.close()
+            os.replace(tmp_filepath, self.filepath)
+            self.dirty = False
+            self.seen = file_versions([self.filepath])
+
+    def changed_on_disk(self):
+        return file_versions([self.filepath]) != self.seen
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+    return response_cache
+
+
+def revalidate_response_cache():
+    # For a resident process, between jobs: ETags saved by another process since this one last
+    # read or wrote them replace the shared copy on the next get_response_cache()
+    global response_cache
+    with response_cache_lock:
+        if response_cache is not None and response_cache.changed_on_disk():
+            logger.write("Response cache changed on disk; reloading")
+            response_cache = None
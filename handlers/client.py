@@ -1,13 +1,126 @@
+import json
 import os
 import os.path
 import pickle
-import google_auth_oauthlib.flow
-import googleapiclient.discovery
-import googleapiclient.errors
-from google_auth_oauthlib import flow
+import threading
+from datetime import datetime
+from handlers import execution, quota
 from handlers.utilities import ConfigHandler, print_json
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+
+# The Google client libraries take half a second to import, so they are only imported once
+# credentials or a client are actually needed
+
+DISCOVERY_ROOT = "https://www.googleapis.com"
+DISCOVERY_PATH = "/discovery/v1/apis/{api}/{apiVersion}/rest"
+DISCOVERY_TIMEOUT = 30
+
+
+class ClientPool:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.credentials = {}
+        self.document = None
+
+    def get_credentials(self, pickle_filepath, secrets_filepath, scopes):
+        with self.lock:
+            creds = self.credentials[pickle_filepath] if pickle_filepath in self.credentials else None
+            # The file token.pickle stores the user's access and refresh tokens, and is
+            # created automatically when the authorization flow completes for the first
+            # time.
+            if creds is None and os.path.exists(pickle_filepath):
+                with open(pickle_filepath, 'rb') as token:
+                    creds = pickle.load(token)
+            # If there are no (valid) credentials available, let the user log in.
+            if not creds or not creds.valid:
+                if creds and creds.expired and creds.refresh_token:
+                    from google.auth.transport.requests import Request
+
+                    creds.refresh(Request())
+                else:
+                    from google_auth_oauthlib.flow import InstalledAppFlow
+
+                    flow = InstalledAppFlow.from_client_secrets_file(
+                        secrets_filepath, scopes)
+                    creds = flow.run_local_server(port=0)
+                # Save the credentials for the next run
+                with open(pickle_filepath, 'wb') as token:
+                    pickle.dump(creds, token)
+            self.credentials[pickle_filepath] = creds
+
+        return creds
+
+    def get_document(self, config):
+        # The discovery document is fetched once and kept on disk, then read once per process and
+        # shared by every thread's build, instead of each build fetching it again. It stays text:
+        # build_from_document fixes up the method descriptions it is given in place.
+        with self.lock:
+            if self.document is not None:
+                return self.document
+
+            root = config.variables['API_ENDPOINT'] if config.variables['API_ENDPOINT'] else DISCOVERY_ROOT
+            url = root.rstrip("/") + DISCOVERY_PATH.format(api=config.variables['API_SERVICE_NAME'],
+                                                           apiVersion=config.variables['API_VERSION'])
+            filepath = config.discovery_cache_filepath
+            cached = None
+            if os.path.exists(filepath):
+                cached = json.load(open(filepath, mode='r'))
+                age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(filepath))
+                if cached['url'] == url and age.days < config.variables['DISCOVERY_CACHE_MAX_AGE_DAYS']:
+                    self.document = cached['document']
+                    return self.document
+
+            try:
+                from urllib.request import urlopen
+
+                document = urlopen(url, timeout=DISCOVERY_TIMEOUT).read().decode('utf-8')
+                json.loads(document)
+            except (OSError, ValueError):
+                # A stale copy beats not starting at all
+                if cached is None or cached['url'] != url:
+                    raise
+                self.document = cached['document']
+                return self.document
+
+            tmp_filepath = filepath + ".tmp"
+            fp = open(tmp_filepath, mode='w')
+            json.dump({'url': url, 'document': document}, fp=fp, separators=(',', ':'))
+            fp.close()
+            os.replace(tmp_filepath, filepath)
+            self.document = document
+
+        return self.document
+
+    def get_client(self, pickle_filepath, secrets_filepath, config):
+        # httplib2 objects are not thread-safe, so each thread builds and keeps its own
+        # Resource; its Http instance then reuses connections across requests.
+        if not hasattr(self.local, 'clients'):
+            self.local.clients = {}
+        clients = self.local.clients
+        if pickle_filepath in clients:
+            return clients[pickle_filepath]
+
+        import googleapiclient.discovery
+
+        document = self.get_document(config)
+        if config.variables['API_ENDPOINT']:
+            # A local stand-in API (bench/fake_api.py) needs no OAuth
+            clients[pickle_filepath] = googleapiclient.discovery.build_from_document(document, developerKey="local")
+        else:
+            creds = self.get_credentials(pickle_filepath, secrets_filepath, list(config.variables['SCOPES']))
+            clients[pickle_filepath] = googleapiclient.discovery.build_from_document(document, credentials=creds)
+
+        return clients[pickle_filepath]
+
+    def forget(self, pickle_filepath):
+        with self.lock:
+            if pickle_filepath in self.credentials:
+                del self.credentials[pickle_filepath]
+        if hasattr(self.local, 'clients') and pickle_filepath in self.local.clients:
+            del self.local.clients[pickle_filepath]
+
+
+pool = ClientPool()
 
 
 class YoutubeClientHandler:
@@ -16,6 +129,7 @@ class YoutubeClientHandler:
         if clear:
             if os.path.exists(self.pickle):
                 os.remove(self.pickle)
+            pool.forget(self.pickle)
 
         self.config = ConfigHandler()
         self.secrets_filepath = self.config.secrets_filepath if secrets_filepath is None else secrets_filepath
@@ -25,42 +139,15 @@ class YoutubeClientHandler:
         self.config = ConfigHandler()
 
     def get_client(self):
-        scopes = self.config.variables['SCOPES']
         os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-        api_service_name = self.config.variables['API_SERVICE_NAME']
-        api_version = self.config.variables['API_VERSION']
-        client_secrets_file = self.secrets_filepath
-
         # Get credentials and create an API client
         # flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
         #     client_secrets_file, scopes)
         # credentials = flow.run_console()
-        creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists(self.pickle):
-            with open(self.pickle, 'rb') as token:
-                creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    client_secrets_file, scopes)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(self.pickle, 'wb') as token:
-                pickle.dump(creds, token)
-
-        youtube = googleapiclient.discovery.build(
-            api_service_name, api_version, credentials=creds)
-
-        return youtube
-
-    def execute(self, request_object):
-        response = request_object.execute()
-
-        return response
\ No newline at end of file
+        return pool.get_client(self.pickle, self.secrets_filepath, self.config)
+
+    def execute(self, request_object, priority=quota.NORMAL):
+        response = execution.execute(request_object, priority)
+
+        return response
@@ -0,0 +1,184 @@
+from handlers import metrics, quota
+from handlers.utilities import ConfigHandler, Logger
+from time import monotonic, sleep
+import json
+import random
+import threading
+
+logger = Logger()
+
+# Retried after backoff; quotaExceeded and other 403/404s are final and raised at once
+RETRY_CODES = [408, 429, 500, 502, 503, 504]
+RETRY_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded', 'backendError', 'internalError']
+
+
+def method_ids(request_object):
+    # A BatchHttpRequest is charged for each request it carries
+    if hasattr(request_object, '_requests'):
+        return [method_id for request in request_object._requests.values() for method_id in method_ids(request)]
+
+    return [request_object.methodId if getattr(request_object, 'methodId', None) else 'youtube.unknown']
+
+
+def error_reasons(content):
+    try:
+        data = json.loads(content.decode('utf-8') if isinstance(content, bytes) else content)
+    except (TypeError, ValueError):
+        return []
+    if not isinstance(data, dict) or not isinstance(data.get('error'), dict):
+        return []
+
+    return [error['reason'] for error in data['error'].get('errors', []) if 'reason' in error]
+
+
+def retry_reason(status, content):
+    # Returns why a failed call is worth retrying, or None if it never will be
+    if status == 304:
+        return None
+    for reason in error_reasons(content):
+        if reason in RETRY_REASONS:
+            return reason
+    if status in RETRY_CODES:
+        return "HTTP %i" % status
+
+    return None
+
+
+def retry_after(headers):
+    if headers is None or 'retry-after' not in headers:
+        return None
+    try:
+        return float(headers['retry-after'])
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        # Takes the tokens now, going into debt if needed; returns how long the caller must wait
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        with self.lock:
+            return max(0, self.open_until - monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        # The count only resets on a success, so once open, the first failed call after the cooldown reopens it
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.open_until = monotonic() + self.cooldown
+                logger.write("Circuit open for %is after %i consecutive failures" % (self.cooldown, self.failures))
+
+
+class Executor:
+    def __init__(self):
+        config = ConfigHandler()
+        self.bucket = TokenBucket(config.variables['API_RATE_PER_SECOND'], config.variables['API_RATE_BURST'])
+        self.breaker = CircuitBreaker(config.variables['API_BREAKER_THRESHOLD'],
+                                      config.variables['API_BREAKER_COOLDOWN'])
+        self.max_retries = config.variables['API_MAX_RETRIES']
+        self.backoff_base = config.variables['API_BACKOFF_BASE']
+        self.backoff_max = config.variables['API_BACKOFF_MAX']
+
+    def retry_delay(self, method_ids, attempt, reason, wait=None):
+        # Returns how long to back off before the next attempt, or None to give up
+        self.breaker.record_failure()
+        if attempt >= self.max_retries:
+            logger.write("Giving up on %s after %i attempts: %s" % (",".join(method_ids), attempt + 1, reason))
+            return None
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if wait is not None:
+            delay = max(delay, wait)
+        logger.write("Retrying %s in %.1fs: %s" % (",".join(method_ids), delay, reason))
+
+        return delay
+
+    def execute(self, request_object, priority=quota.NORMAL):
+        import googleapiclient.errors
+        import httplib2
+
+        ids = method_ids(request_object)
+        recorder = metrics.get_metrics()
+        recorder.measure(request_object)
+        attempt = 0
+        elapsed = 0.0
+        waited = 0.0
+        while True:
+            started = monotonic()
+            sleep(self.breaker.wait_time())
+            sleep(self.bucket.reserve(len(ids)))
+            quota.get_ledger().charge(ids, priority)
+            sent = monotonic()
+            waited += sent - started
+            try:
+                response = request_object.execute()
+            except googleapiclient.errors.HttpError as e:
+                elapsed += monotonic() - sent
+                reason = retry_reason(e.resp.status, e.content)
+                if reason is None:
+                    self.breaker.record_success()
+                    recorder.record(ids, elapsed, attempt, e.resp.status, waited)
+                    raise
+                delay = self.retry_delay(ids, attempt, reason, retry_after(e.resp))
+                if delay is None:
+                    recorder.record(ids, elapsed, attempt, e.resp.status, waited)
+                    raise
+            except (OSError, httplib2.HttpLib2Error) as e:
+                # Transport failures with no HTTP response: dropped sockets, timeouts, TLS and DNS errors
+                elapsed += monotonic() - sent
+                delay = self.retry_delay(ids, attempt, repr(e))
+                if delay is None:
+                    recorder.record(ids, elapsed, attempt, metrics.NO_RESPONSE, waited)
+                    raise
+            else:
+                elapsed += monotonic() - sent
+                self.breaker.record_success()
+                recorder.record(ids, elapsed, attempt, 200, waited)
+                return response
+
+            sleep(delay)
+            waited += delay
+            attempt += 1
+
+
+executor = None
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = Executor()
+    return executor
+
+
+def execute(request_object, priority=quota.NORMAL):
+    return get_executor().execute(request_object, priority)
@@ -0,0 +1,139 @@
+from os import path
+import heapq
+import mmap
+import os
+import threading
+
+# YouTube video IDs are 11 characters; anything else is left to the in-memory index
+WIDTH = 11
+WRITE_CHUNK = 65536
+
+
+def to_key(vid_id):
+    try:
+        key = vid_id.encode('ascii')
+    except (AttributeError, UnicodeEncodeError):
+        return None
+    return key if len(key) == WIDTH else None
+
+
+class VideoIdIndex:
+    # Every video ID ever recorded, as fixed-width keys in one sorted file that is memory-mapped
+    # and searched by bisection, plus a small unsorted delta file of keys added since the last
+    # merge. Opening it costs one mmap and a read of the delta, however long the history is.
+    def __init__(self, filepath, merge_threshold):
+        self.filepath = filepath
+        self.delta_filepath = filepath + ".delta"
+        self.merge_threshold = merge_threshold
+        self.lock = threading.Lock()
+        self.fp = None
+        self.map = None
+        self.count = 0
+        self.delta = set()
+        self.open()
+
+    def exists(self):
+        return path.exists(self.filepath)
+
+    def open(self):
+        self.close()
+        if self.exists() and path.getsize(self.filepath) >= WIDTH:
+            self.fp = open(self.filepath, mode='rb')
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            self.count = len(self.map) // WIDTH
+        self.delta = set()
+        if path.exists(self.delta_filepath):
+            fp = open(self.delta_filepath, mode='rb')
+            data = fp.read()
+            fp.close()
+            # A torn last key from an interrupted append is dropped; the journal still has it
+            for offset in range(0, len(data) - len(data) % WIDTH, WIDTH):
+                self.delta.add(data[offset:offset + WIDTH])
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.fp.close()
+        self.fp = None
+        self.map = None
+        self.count = 0
+
+    def key_at(self, position):
+        return self.map[position * WIDTH:(position + 1) * WIDTH]
+
+    def in_sorted(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low < self.count and self.key_at(low) == key
+
+    def contains(self, vid_id):
+        key = to_key(vid_id)
+        if key is None:
+            return False
+        with self.lock:
+            return key in self.delta or self.in_sorted(key)
+
+    def add(self, vid_ids):
+        with self.lock:
+            keys = set()
+            for vid_id in vid_ids:
+                key = to_key(vid_id)
+                if key is not None and key not in self.delta and not self.in_sorted(key):
+                    keys.add(key)
+            if len(keys) == 0:
+                return
+
+            fp = open(self.delta_filepath, mode='ab')
+            fp.write(b"".join(sorted(keys)))
+            fp.flush()
+            os.fsync(fp.fileno())
+            fp.close()
+            self.delta.update(keys)
+
+            if len(self.delta) > max(self.merge_threshold, self.count // 8):
+                self.merge()
+
+    def sorted_keys(self):
+        for position in range(self.count):
+            yield self.key_at(position)
+
+    def write_keys(self, keys):
+        tmp_filepath = self.filepath + ".tmp"
+        fp = open(tmp_filepath, mode='wb')
+        chunk = []
+        previous = None
+        for key in keys:
+            if key == previous:
+                continue
+            chunk.append(key)
+            previous = key
+            if len(chunk) >= WRITE_CHUNK:
+                fp.write(b"".join(chunk))
+                chunk = []
+        fp.write(b"".join(chunk))
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        self.close()
+        os.replace(tmp_filepath, self.filepath)
+        fp = open(self.delta_filepath, mode='wb')
+        fp.close()
+        self.open()
+
+    def merge(self):
+        # Streams the mapped file and the sorted delta into a new file; memory stays at the delta's size
+        self.write_keys(heapq.merge(self.sorted_keys(), sorted(self.delta)))
+
+    def build(self, vid_ids):
+        keys = set()
+        for vid_id in vid_ids:
+            key = to_key(vid_id)
+            if key is not None:
+                keys.add(key)
+        with self.lock:
+            self.write_keys(sorted(keys))
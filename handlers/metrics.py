@@ -0,0 +1,211 @@
+from handlers.utilities import ConfigHandler
+from datetime import datetime
+from os import path
+import atexit
+import bisect
+import json
+import os
+import sys
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets, Prometheus style
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+# Status recorded when a request failed without an HTTP response
+NO_RESPONSE = 0
+
+
+def script_name():
+    return path.splitext(path.basename(sys.argv[0]))[0] if sys.argv and sys.argv[0] else "python"
+
+
+def method_label(method_ids):
+    # A batch of 50 inserts is one request labelled youtube.playlistItems.insert carrying 50 calls
+    return "+".join(sorted(set(method_ids)))
+
+
+class Series:
+    def __init__(self):
+        self.requests = 0
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.wait_seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.statuses = {}
+
+    def observe(self, calls, seconds, retries, status, waited):
+        self.requests += 1
+        self.calls += calls
+        self.retries += retries
+        self.seconds += seconds
+        self.wait_seconds += waited
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        if status == NO_RESPONSE or status >= 400:
+            self.errors += 1
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'seconds': round(self.seconds, 6),
+            'wait_seconds': round(self.wait_seconds, 6),
+            'mean_seconds': round(self.seconds / self.requests, 6) if self.requests > 0 else 0,
+            'bytes': self.bytes,
+            'statuses': self.statuses,
+            'buckets': dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], self.buckets))
+        }
+
+
+class Metrics:
+    def __init__(self):
+        config = ConfigHandler()
+        self.enabled = config.variables['METRICS_ENABLED']
+        self.directory = path.join(config.log_path, config.variables['METRICS_DIR'])
+        self.date_format = config.variables['LOG_DATE_FORMAT']
+        self.script = script_name()
+        self.phase = self.script
+        self.started = datetime.now()
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def start(self, script):
+        # A resident process runs several jobs; each gets its own summary
+        with self.lock:
+            self.script = script
+            self.phase = script
+            self.started = datetime.now()
+            self.series = {}
+
+    def set_phase(self, phase):
+        # Phases run one after another, so a single process-wide label is enough for the worker threads too
+        self.phase = phase
+
+    def get_series(self, method):
+        key = (self.phase, method)
+        if key not in self.series:
+            self.series[key] = Series()
+        return self.series[key]
+
+    def record(self, method_ids, seconds, retries=0, status=200, waited=0.0):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.get_series(method_label(method_ids)).observe(len(method_ids), seconds, retries, status, waited)
+
+    def add_bytes(self, method_id, size):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.get_series(method_id).bytes += size
+
+    def measure(self, request_object):
+        # Counts response bodies as googleapiclient hands them to the JSON parser; a batch calls
+        # each inner request's postproc with that request's part of the multipart body
+        if not self.enabled:
+            return
+        requests = request_object._requests.values() if hasattr(request_object, '_requests') else [request_object]
+        for request in requests:
+            if getattr(request, 'postproc', None) is None or getattr(request.postproc, 'measured', False):
+                continue
+            request.postproc = self.counting_postproc(request.postproc, getattr(request, 'methodId', None) or
+                                                      'youtube.unknown')
+
+    def counting_postproc(self, postproc, method_id):
+        def counted(resp, content):
+            self.add_bytes(method_id, len(content) if content else 0)
+            return postproc(resp, content)
+
+        counted.measured = True
+        return counted
+
+    def summary(self):
+        with self.lock:
+            phases = {}
+            for phase, method in sorted(self.series):
+                if phase not in phases:
+                    phases[phase] = {}
+                phases[phase][method] = self.series[(phase, method)].summary()
+
+        return {
+            'script': self.script,
+            'started': self.started.strftime("%Y-%m-%d %H:%M:%S"),
+            'finished': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'phases': phases
+        }
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            keys = sorted(self.series)
+            series = dict((key, self.series[key]) for key in keys)
+
+            def labels(phase, method, extra=""):
+                return '{script="%s",phase="%s",method="%s"%s}' % (self.script, phase, method, extra)
+
+            for name, kind, field, text in [
+                ("youtube_api_requests_total", "counter", 'requests', "Executed requests; a retried request counts once"),
+                ("youtube_api_calls_total", "counter", 'calls', "API calls, counting each request inside a batch"),
+                ("youtube_api_errors_total", "counter", 'errors', "Requests that finally failed"),
+                ("youtube_api_retries_total", "counter", 'retries', "Extra attempts after a retryable failure"),
+                ("youtube_api_response_bytes_total", "counter", 'bytes', "Response body bytes"),
+                ("youtube_api_wait_seconds_total", "counter", 'wait_seconds',
+                 "Time spent throttled or backing off before attempts")
+            ]:
+                lines.append("# HELP %s %s" % (name, text))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for phase, method in keys:
+                    lines.append("%s%s %s" % (name, labels(phase, method), getattr(series[(phase, method)], field)))
+
+            name = "youtube_api_request_duration_seconds"
+            lines.append("# HELP %s Time from the first attempt until a response, excluding waits" % name)
+            lines.append("# TYPE %s histogram" % name)
+            for phase, method in keys:
+                observed = series[(phase, method)]
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], observed.buckets):
+                    cumulative += count
+                    lines.append("%s_bucket%s %i" % (name, labels(phase, method, ',le="%s"' % bound), cumulative))
+                lines.append("%s_sum%s %f" % (name, labels(phase, method), observed.seconds))
+                lines.append("%s_count%s %i" % (name, labels(phase, method), observed.requests))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        if not self.enabled or len(self.series) == 0:
+            return
+        if not path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # A timestamped summary per run, and a .prom that always holds the latest run for a textfile collector
+        basename = path.join(self.directory, "%s.%s" % (self.script, self.started.strftime(self.date_format)))
+        fp = open(basename + ".json", mode='w')
+        json.dump(self.summary(), fp=fp, separators=(',', ': '), indent=2, sort_keys=True)
+        fp.close()
+
+        prom_filepath = path.join(self.directory, self.script + ".prom")
+        fp = open(prom_filepath + ".tmp", mode='w')
+        fp.write(self.prometheus())
+        fp.close()
+        os.replace(prom_filepath + ".tmp", prom_filepath)
+
+
+metrics = None
+metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global metrics
+    with metrics_lock:
+        if metrics is None:
+            metrics = Metrics()
+            atexit.register(metrics.write)
+    return metrics
+
+
+def set_phase(phase):
+    get_metrics().set_phase(phase)
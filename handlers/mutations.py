@@ -0,0 +1,108 @@
+from handlers import quota
+from time import sleep
+
+BATCH_SIZE = 50
+
+
+class Mutation:
+    def __init__(self, kind, request, item=None):
+        self.kind = kind
+        self.request = request
+        self.item = item
+        self.response = None
+        self.error = None
+
+    def succeeded(self):
+        return self.error is None
+
+
+class Skipped(Exception):
+    pass
+
+
+class MutationExecutor:
+    def __init__(self, client, execute, priority=quota.NORMAL):
+        self.client = client
+        self.execute = execute
+        self.priority = priority
+
+    def run_ordered(self, mutations):
+        import googleapiclient.errors
+
+        # Position-dependent mutations are sent one at a time, in order. Each position assumes
+        # the ones before it landed, so the rest are skipped after a failure for the caller to re-plan.
+        for index, mutation in enumerate(mutations):
+            try:
+                mutation.response = self.execute(mutation.request, self.priority)
+            except googleapiclient.errors.HttpError as e:
+                mutation.error = e
+                for remaining in mutations[index + 1:]:
+                    remaining.error = Skipped("Not sent after an earlier placement failed")
+                break
+            except (quota.QuotaDeferred, quota.QuotaExhausted) as e:
+                for remaining in mutations[index:]:
+                    remaining.error = e
+                break
+
+        return mutations
+
+    def run_batched(self, mutations):
+        from handlers import execution
+
+        # Sub-requests that failed with a retryable error go out again in follow-up batches,
+        # backing off as execute() does for whole requests
+        executor = execution.get_executor()
+        pending = mutations
+        attempt = 0
+        while len(pending) > 0:
+            self.send_batches(pending)
+            pending = [mutation for mutation in pending if self.retry_reason(mutation) is not None]
+            if len(pending) == 0:
+                break
+            ids = sorted(set(method_id for mutation in pending for method_id in execution.method_ids(mutation.request)))
+            delay = executor.retry_delay(ids, attempt, "%i batched requests: %s" % (
+                len(pending), self.retry_reason(pending[0])))
+            if delay is None:
+                break
+            sleep(delay)
+            attempt += 1
+            for mutation in pending:
+                mutation.error = None
+                mutation.response = None
+
+        return mutations
+
+    def retry_reason(self, mutation):
+        import googleapiclient.errors
+        from handlers import execution
+
+        if not isinstance(mutation.error, googleapiclient.errors.HttpError):
+            return None
+        return execution.retry_reason(mutation.error.resp.status, mutation.error.content)
+
+    def send_batches(self, mutations):
+        import googleapiclient.errors
+
+        # Independent mutations share batch requests; the API may apply them in any order
+        for start in range(0, len(mutations), BATCH_SIZE):
+            chunk = mutations[start:start + BATCH_SIZE]
+            batch = self.client.new_batch_http_request()
+            for request_id, mutation in enumerate(chunk):
+                batch.add(mutation.request, callback=self.callback(mutation), request_id=str(request_id))
+            try:
+                self.execute(batch, self.priority)
+            except googleapiclient.errors.HttpError as e:
+                for mutation in chunk:
+                    if mutation.response is None and mutation.error is None:
+                        mutation.error = e
+            except (quota.QuotaDeferred, quota.QuotaExhausted) as e:
+                for mutation in mutations[start:]:
+                    mutation.error = e
+                break
+
+    def callback(self, mutation):
+        def store_result(request_id, response, exception):
+            mutation.response = response
+            mutation.error = exception
+
+        return store_result
@@ -1,11 +1,12 @@
-from handlers import client, utilities, ranks
+from handlers import cache, client, idindex, metrics, utilities, ranks, shards, snippets, videos, workers, quota
+import atexit
 import json
-from time import sleep
+import os
+import queue
 from datetime import datetime, timedelta
+from time import monotonic
 from handlers.utilities import Logger
-import googleapiclient.errors
 import threading
-import copy
 
 logger = Logger()
 
@@ -15,7 +16,8 @@ class YoutubePlaylist:
         self.tier = kwargs['tier']
         self.id = kwargs['id']
         self.videos = []
-        self.client = client.YoutubeClientHandler().get_client()
+        self.youtube = client.YoutubeClientHandler()
+        self.client = self.youtube.client
 
     def get_items(self):
         kwargs = {
@@ -25,13 +27,13 @@ class YoutubePlaylist:
         }
 
         request = self.client.playlistItems().list(**kwargs)
-        response = request.execute()
+        response = self.youtube.execute(request)
         self.videos = response['items']
 
         while 'nextPageToken' in response:
             kwargs['pageToken'] = response['nextPageToken']
             request = self.client.playlistItems().list(**kwargs)
-            response = request.execute()
+            response = self.youtube.execute(request)
             self.videos = self.videos + response['items']
 
     def add_item(self, **kwargs):
@@ -58,35 +60,205 @@ class YoutubePlaylist:
         return None
 
 
+class VideoIndex:
+    def __init__(self, videos_added=None):
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.videos = set()
+        if videos_added is not None:
+            for date in videos_added:
+                for channel_id in videos_added[date]:
+                    for vid_id in videos_added[date][channel_id]:
+                        self.add(channel_id, vid_id)
+
+    def add(self, channel_id, vid_id):
+        with self.lock:
+            if channel_id not in self.channels:
+                self.channels[channel_id] = set()
+            self.channels[channel_id].add(vid_id)
+            self.videos.add(vid_id)
+
+    def channel_videos(self, channel_id):
+        return self.channels[channel_id] if channel_id in self.channels else set()
+
+    def contains(self, vid_id, channel_id=None):
+        if channel_id is None:
+            return vid_id in self.videos
+        return vid_id in self.channel_videos(channel_id)
+
+
 class Records:
     def __init__(self):
         config = utilities.ConfigHandler()
-        self.date = datetime.now().strftime(config.variables['DATE_FORMAT'])
+        self.date_format = config.variables['DATE_FORMAT']
         self.youtube_date_format = config.variables['YOUTUBE_DATE_FORMAT']
         self.filepath = config.records_filepath
-        self.data = json.load(open(self.filepath, mode='r'))
-        if 'dates' not in self.data:
-            self.data['dates'] = {
-                'previously_added': {}
-            }
-        if 'latest' not in self.data:
-            self.data['latest'] = {}
-        self.videos_added = self.data['dates']
-        self.latest_videos = self.data['latest']
+        self.directory = config.records_dirpath
+        self.shard_format = config.variables['RECORDS_SHARD_FORMAT']
+        self.journal_filepath = os.path.join(self.directory, "journal")
+        self.journal_max_bytes = config.variables['RECORDS_JOURNAL_MAX_BYTES']
+        self.commit_batch = config.variables['RECORDS_COMMIT_BATCH']
+        self.commit_interval = config.variables['RECORDS_COMMIT_INTERVAL_MS'] / 1000
+        self.committer = None
+        self.ids = None
+        self.lock = threading.RLock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.store = shards.RecordShards(self.directory, self.date_format, self.shard_format)
+        if not self.store.exists() and os.path.exists(self.filepath):
+            self.migrate()
+        self.videos_added = self.store.dates
+        self.latest_videos = self.store.latest
+        self.index = VideoIndex()
+        self.pending_ids = set()
+        # Anything published inside the search window was queued inside it too; the extra day
+        # covers queue dates being local time
+        since = datetime.now() - timedelta(days=config.variables['DAYS_TO_SEARCH'] + 1)
+        self.index_dates(self.store.load_since(since))
+        # Older history is answered by the ID index instead of loading its shards
+        self.ids = idindex.VideoIdIndex(os.path.join(self.directory, "videos.idx"),
+                                        config.variables['RECORDS_ID_INDEX_MERGE'])
+        if not self.ids.exists():
+            logger.write("Building the video ID index from %i shards" % len(self.store.shards))
+            self.ids.build(self.store.video_ids())
+        self.replay_journal(self.journal_filepath)
+        self.seen = self.disk_versions()
+
+    def disk_versions(self):
+        return utilities.file_versions([self.store.index_filepath, self.ids.filepath, self.ids.delta_filepath,
+                                        self.journal_filepath])
+
+    def changed_on_disk(self):
+        return self.disk_versions() != self.seen
+
+    def close(self):
+        if self.committer is not None:
+            self.committer.close()
+        self.ids.close()
+
+    def migrate(self):
+        # One-time split of records.json and its journal into shards; the old file is kept aside
+        logger.write("Migrating %s to %s" % (self.filepath, self.directory))
+        data = json.load(open(self.filepath, mode='r'))
+        dates = data['dates'] if 'dates' in data else {}
+        self.store.dates.update(dates)
+        self.store.latest.update(data['latest'] if 'latest' in data else {})
+        self.videos_added = self.store.dates
+        self.latest_videos = self.store.latest
+        if len(self.latest_videos) == 0:
+            # One-time backfill of the per-channel watermarks from history
+            for date in self.videos_added:
+                for channel_id in self.videos_added[date]:
+                    for vid_id in self.videos_added[date][channel_id]:
+                        self.update_latest(self.videos_added[date][channel_id][vid_id])
+        for date in dates:
+            self.store.loaded.add(self.store.shard_key(date))
+            self.store.dirty.add(self.store.shard_key(date))
+        self.index = VideoIndex()
+        self.pending_ids = set()
+        self.replay_journal(self.filepath + ".journal")
+        self.write_records()
+
+        os.replace(self.filepath, self.filepath + ".migrated")
+        if os.path.exists(self.filepath + ".journal"):
+            os.remove(self.filepath + ".journal")
+        self.store = shards.RecordShards(self.directory, self.date_format, self.shard_format)
+
+    def index_dates(self, dates):
+        for date in dates:
+            for channel_id in dates[date]:
+                for vid_id in dates[date][channel_id]:
+                    self.index.add(channel_id, vid_id)
+
+    def load_all(self):
+        with self.lock:
+            self.index_dates(self.store.load_all())
 
     def write_records(self):
-        fp = open(self.filepath, mode='w')
-        utilities.print_json(self.data, fp=fp)
+        # Serialise under the lock for a consistent snapshot, then replace the files atomically
+        with self.lock:
+            dirty = self.store.dirty
+            files = self.store.serialise()
+            pending_ids = self.pending_ids
+            self.pending_ids = set()
+        try:
+            self.store.write(files)
+        except Exception:
+            # Left for the next snapshot to retry
+            with self.lock:
+                self.store.dirty |= dirty
+                self.pending_ids |= pending_ids
+            raise
+        # Shards first: an ID is only ever in the index once its record is on disk
+        if self.ids is not None:
+            self.ids.add(pending_ids)
+
+    def get_committer(self):
+        with self.lock:
+            if self.committer is None:
+                self.committer = RecordsCommitter(self, self.commit_batch, self.commit_interval)
+                atexit.register(self.committer.close)
+        return self.committer
+
+    def replay_journal(self, journal_filepath):
+        if not os.path.exists(journal_filepath):
+            return 0
+
+        replayed = 0
+        fp = open(journal_filepath, mode='r', encoding="utf-8")
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A partially written last line from an interrupted run
+                continue
+            self.apply_record(entry['date'], entry['record'])
+            self.index.add(entry['record']['channelId'], entry['record']['videoId'])
+            replayed += 1
+        fp.close()
+
+        return replayed
+
+    def compact(self):
+        self.get_committer().compact()
+
+    def truncate_journal(self):
+        fp = open(self.journal_filepath, mode='w')
         fp.close()
 
+    def apply_record(self, date, record):
+        self.index_dates(self.store.touch(date))
+        if date not in self.videos_added:
+            self.videos_added[date] = {}
+        if record['channelId'] not in self.videos_added[date]:
+            self.videos_added[date][record['channelId']] = {}
+        self.videos_added[date][record['channelId']][record['videoId']] = record
+        self.pending_ids.add(record['videoId'])
+        self.update_latest(record)
+
+    def update_latest(self, record):
+        if 'publishedAt' not in record or 'channelId' not in record:
+            return
+        channel_id = record['channelId']
+        # Compare on the second-resolution prefix, which sorts the same across date formats
+        published = record['publishedAt'][:19]
+        if channel_id not in self.latest_videos or self.latest_videos[channel_id]['publishedAt'][:19] < published:
+            self.latest_videos[channel_id] = {
+                'videoId': record['videoId'],
+                'publishedAt': record['publishedAt']
+            }
+
+    def channel_watermark(self, channel_id):
+        if channel_id not in self.latest_videos:
+            return None
+
+        return datetime.strptime(self.latest_videos[channel_id]['publishedAt'][:19], "%Y-%m-%dT%H:%M:%S")
+
     def channel_vids_added(self, channel_id):
-        channel_video_ids = {}
-        for date in self.videos_added:
-            if channel_id in self.videos_added[date]:
-                for vid_id in self.videos_added[date][channel_id]:
-                    channel_video_ids[vid_id] = self.videos_added[date][channel_id][vid_id]
+        return self.index.channel_videos(channel_id)
 
-        return channel_video_ids
+    def vid_added(self, vid_id, channel_id=None):
+        return self.index.contains(vid_id, channel_id) or self.ids.contains(vid_id)
 
     def add_record(self, vid_data):
         record = {
@@ -97,12 +269,135 @@ class Records:
             'title': vid_data['snippet']['title']
         }
 
-        if self.date not in self.videos_added:
-            self.videos_added[self.date] = {}
-        if record['channelId'] not in self.videos_added[self.date]:
-            self.videos_added[self.date][record['channelId']] = {}
-        self.videos_added[self.date][record['channelId']][record['videoId']] = record
-        self.write_records()
+        # Taken per record, since a resident process outlives the day it started on
+        date = datetime.now().strftime(self.date_format)
+        committer = self.get_committer()
+        with self.lock:
+            self.apply_record(date, record)
+            self.index.add(record['channelId'], record['videoId'])
+            committer.submit({'date': date, 'record': record})
+
+
+class RecordsCommitter:
+    # The only writer of the records journal and snapshot. Scanner threads submit entries
+    # and return at once; entries are appended and fsynced in groups of up to batch_size,
+    # or whatever arrived within interval seconds of the first one.
+    def __init__(self, records, batch_size, interval):
+        self.records = records
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="records-commit", daemon=True)
+        self.thread.start()
+
+    def submit(self, entry):
+        self.queue.put(entry)
+
+    def request(self, action):
+        done = threading.Event()
+        self.queue.put((action, done))
+        done.wait()
+        # A failed write is raised once, to the next caller waiting on the committer
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def compact(self):
+        self.request(COMPACT)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        running = True
+        while running:
+            group = [self.queue.get()]
+            deadline = monotonic() + self.interval
+            while len(group) < self.batch_size and isinstance(group[-1], dict):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    group.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            running = None not in group
+            try:
+                entries = []
+                for item in group:
+                    if isinstance(item, tuple):
+                        self.append(entries)
+                        entries = []
+                        if item[0] == COMPACT:
+                            self.write_snapshot()
+                        item[1].set()
+                    elif item is not None:
+                        entries.append(item)
+                self.append(entries)
+            except Exception as e:
+                # The entries are still applied in memory, so a later snapshot can write them
+                logger.write("Records commit failed: %s" % repr(e))
+                self.error = e
+            finally:
+                # Waiters are always released, or a failed write would hang them for good
+                for item in group:
+                    if isinstance(item, tuple):
+                        item[1].set()
+
+    def append(self, entries):
+        if len(entries) == 0:
+            return
+        fp = open(self.records.journal_filepath, mode='a', encoding="utf-8")
+        fp.write("".join(json.dumps(entry, separators=(',', ':')) + "\n" for entry in entries))
+        fp.flush()
+        os.fsync(fp.fileno())
+        journal_size = fp.tell()
+        fp.close()
+        self.records.seen = self.records.disk_versions()
+
+        if journal_size > self.records.journal_max_bytes:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # Entries still queued were applied in memory too, so at worst they are journalled
+        # again after the truncate; replaying an entry twice is harmless
+        self.records.write_records()
+        self.records.truncate_journal()
+        self.records.seen = self.records.disk_versions()
+
+
+COMPACT = 'compact'
+
+
+shared_records = None
+shared_records_lock = threading.Lock()
+
+
+def get_records():
+    # Every scanner in a process shares one Records instance and its seen-video index
+    global shared_records
+    with shared_records_lock:
+        if shared_records is None:
+            shared_records = Records()
+    return shared_records
+
+
+def revalidate_records():
+    # For a resident process, between jobs: records written by another process (fetch.py -a,
+    # a manual run) since this one last read or wrote them replace the shared copy, so it
+    # neither re-queues their videos nor overwrites their shards from a stale copy
+    global shared_records
+    with shared_records_lock:
+        if shared_records is not None and shared_records.changed_on_disk():
+            logger.write("Records changed on disk; reloading")
+            shared_records.close()
+            shared_records = None
 
 
 class LegacyRecords(Records):
@@ -112,7 +407,6 @@ class LegacyRecords(Records):
         self.legacy_filepath = config.records_filepath + ".legacy" if legacy_filepath is None \
             else legacy_filepath
         self.legacy_data = json.load(open(self.legacy_filepath, mode='r'))
-        self.videos_added = self.import_legacy()
 
     def import_legacy(self):
         new_json = {}
@@ -127,18 +421,22 @@ class LegacyRecords(Records):
         return new_json
 
     def combine_data(self):
-        new_json = {}
-        for data_source in [self.data['dates'], self.import_legacy()]:
-            for date in data_source:
-                if date not in new_json:
-                    new_json[date] = {}
-                for channel_id in data_source[date]:
-                    if channel_id not in new_json[date]:
-                        new_json[date][channel_id] = {}
-                    for vid_id in data_source[date][channel_id]:
-                        new_json[date][channel_id][vid_id] = data_source[date][channel_id][vid_id]
-
-        self.data['dates'] = new_json
+        # Legacy dates can land in any shard, so everything is read first and rewritten by compact()
+        self.load_all()
+        legacy = self.import_legacy()
+        with self.lock:
+            for date in legacy:
+                self.index_dates(self.store.touch(date))
+                if date not in self.videos_added:
+                    self.videos_added[date] = {}
+                for channel_id in legacy[date]:
+                    if channel_id not in self.videos_added[date]:
+                        self.videos_added[date][channel_id] = {}
+                    for vid_id in legacy[date][channel_id]:
+                        self.videos_added[date][channel_id][vid_id] = legacy[date][channel_id][vid_id]
+                        self.update_latest(legacy[date][channel_id][vid_id])
+                        self.index.add(channel_id, vid_id)
+                        self.pending_ids.add(vid_id)
 
 
 class SubscribedChannel:
@@ -147,104 +445,159 @@ class SubscribedChannel:
         self.name = kwargs['name']
         self.playlist_id = kwargs['uploads']
         self.channel_id = kwargs['id']
-        self.records = Records()
+        self.records = get_records()
         config = utilities.ConfigHandler()
         self.queue_id = config.variables['QUEUE_ID']
         self.date_format = config.variables['YOUTUBE_DATE_FORMAT']
         self.oldest_date = kwargs['oldest_date']
+        self.priority = kwargs['priority'] if 'priority' in kwargs else quota.NORMAL
+        self.response_cache = cache.get_response_cache()
+        self.unchanged = True
 
     def get_latest(self, all=False):
+        items = self.get_uploads(all=all)
+
+        threads = []
+        for page_num, page_list in enumerate(self.detail_pages(items)):
+            page_id = "%s Page %i" % (self.name, page_num)
+            request = RequestThreader(page_id=page_id, channel=self, page_list=page_list)
+            threads.append(request)
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        results = []
+        for thread in threads:
+            results += thread.response
+
+        self.set_newest(results)
+
+    def get_uploads(self, all=False):
         logger.write("Getting latest videos: %s" % self.name)
         youtube = client.YoutubeClientHandler()
 
-        request = youtube.client.playlistItems().list(
-            part="contentDetails",
-            maxResults=50,
-            playlistId=self.playlist_id
-        )
-
-        response = youtube.execute(request)
+        horizon = self.upload_horizon()
 
-        items = response['items']
+        response = self.get_uploads_page(youtube)
+        items = list(response['items'])
 
         pages = 1
         if all:
-            while 'nextPageToken' in response:
-                request = youtube.client.playlistItems().list(
-                    part="contentDetails",
-                    maxResults=50,
-                    playlistId=self.playlist_id,
-                    pageToken=response['nextPageToken']
-                )
-                response = youtube.execute(request)
-                items = items + response['items']
+            while 'nextPageToken' in response and not self.crosses(response['items'], horizon):
+                response = self.get_uploads_page(youtube, page_token=response['nextPageToken'])
+                items += response['items']
                 pages += 1
         logger.write("Pages of videos for %s: %i" % (self.name, pages))
         logger.write("Videos fetched for %s: %i" % (self.name, len(items)))
 
-        request_list = [
-            []
-        ]
-        counter = 0
+        return items
+
+    def upload_horizon(self):
+        # Uploads come newest first, so nothing past the search window or the newest
+        # video already recorded for this channel needs to be paged in.
+        horizon = self.oldest_date
+        watermark = self.records.channel_watermark(self.channel_id)
+        if watermark is not None and watermark > horizon:
+            horizon = watermark
+
+        return horizon
+
+    def crosses(self, items, horizon):
+        for item in items:
+            published_date = self.item_published_date(item)
+            if published_date is not None and published_date <= horizon:
+                return True
+        return False
+
+    def item_published_date(self, item):
+        if 'videoPublishedAt' not in item['contentDetails']:
+            return None
+        published_date = str(item['contentDetails']['videoPublishedAt']).split('.')[0].replace("Z", "")+".0"
+
+        return datetime.strptime(published_date, self.date_format)
+
+    def get_uploads_page(self, youtube, page_token=None):
+        import googleapiclient.errors
+
+        kwargs = {
+            'part': "contentDetails",
+            'maxResults': 50,
+            'playlistId': self.playlist_id
+        }
+        if page_token is not None:
+            kwargs['pageToken'] = page_token
+        request = youtube.client.playlistItems().list(**kwargs)
+
+        # Revalidate against the last response; a 304 costs no download and returns the cached page
+        cached = self.response_cache.get(self.playlist_id, page_token)
+        if cached is not None:
+            request.headers['If-None-Match'] = cached['etag']
+
+        try:
+            response = youtube.execute(request, self.priority)
+        except googleapiclient.errors.HttpError as e:
+            if cached is not None and e.resp.status == 304:
+                return cached
+            raise
+
+        self.unchanged = False
+        self.response_cache.put(self.playlist_id, page_token, response)
+
+        return response
+
+    def detail_pages(self, items):
+        request_list = []
         total = 0
-        page = 0
-        results = []
+        if self.unchanged:
+            # A 304 only saves the download: videos left unrecorded by an earlier scan (failed
+            # inserts or detail pages, premieres) are still on the cached page and are checked again
+            logger.write("No new uploads for %s" % self.name)
+
         for item in items:
             vid_id = item['contentDetails']['videoId']
-            published_date = str(item['contentDetails']['videoPublishedAt']).split('.')[0].replace("Z", "")+".0"
+            published_date = self.item_published_date(item)
+            if published_date is None:
+                continue
             record = {
                 'videoId': vid_id,
-                'publishedAt': datetime.strptime(published_date, self.date_format),
+                'publishedAt': published_date,
                 'channelId': self.channel_id
             }
             if self.vid_is_valid(record):
-                request_list[page].append(vid_id)
-                counter += 1
+                if total % 50 == 0:
+                    request_list.append([])
+                request_list[-1].append(vid_id)
                 total += 1
-            if counter == 50:
-                counter = 0
-                request_list.append([])
-                page += 1
 
         logger.write("Videos requiring additional details for %s: %i" % (self.name, total))
 
-        page_num = 0
-        threads = []
-        for page_list in request_list:
-            id_list = ",".join(page_list)
-            kwargs = {
-                "part": "snippet",
-                "id": id_list
-            }
-            page_id = "%s Page %i" % (self.name, page_num)
-            page_num += 1
-            request = RequestThreader(page_id=page_id, request_kwargs=kwargs)
-            threads.append(request)
+        return request_list
 
-        for thread in threads:
-            thread.start()
+    def get_details(self, page_list):
+        found = videos.get_video_cache().lookup(page_list, self.fetch_details)
 
-        for thread in threads:
-            thread.join()
+        return [found[vid_id] for vid_id in page_list if vid_id in found]
 
-        for thread in threads:
-            # response = thread.response
-            # request = youtube.client.videos().list(**kwargs)
-            # response = youtube.execute(request)
-            results += thread.response['items']
+    def fetch_details(self, page_list):
+        youtube = client.YoutubeClientHandler()
+        request = youtube.client.videos().list(
+            part="snippet,contentDetails",
+            id=",".join(page_list)
+        )
+        response = youtube.execute(request, self.priority)
 
+        return response['items']
+
+    def set_newest(self, results):
         for vid_details in results:
             vid_details['snippet']['publishedAt'] = self.correct_date_format(vid_details['snippet']['publishedAt'])
 
         results = sorted(results, reverse=True, key=lambda x: x['snippet']['publishedAt'])
         self.newest = results
 
-        # for item in items:
-        #     if self.records.is_newer(last_video_recorded['publishedAt'], item['snippet']['publishedAt']):
-        #         self.newest.append(item)
-        #     else:
-        #         break
-
     def correct_date_format(self, published):
         if 'Z' in published:
             published = published[:-1]
@@ -258,23 +611,22 @@ class SubscribedChannel:
 
     def vid_is_valid(self, record):
         if record['publishedAt'] > self.oldest_date:
-            if record['videoId'] not in self.records.channel_vids_added(record['channelId']):
+            if not self.records.vid_added(record['videoId'], record['channelId']):
                 return True
         return False
 
 
 class RequestThreader(threading.Thread):
-    def __init__(self, page_id, request_kwargs):
+    def __init__(self, page_id, channel, page_list):
         super().__init__()
-        self.kwargs = request_kwargs
         self.name = page_id
+        self.channel = channel
+        self.page_list = page_list
         self.response = None
 
     def run(self):
         logger.write("Starting RequestThreader thread: %s" % self.name)
-        youtube = client.YoutubeClientHandler()
-        request = youtube.client.videos().list(**self.kwargs)
-        self.response = youtube.execute(request)
+        self.response = self.channel.get_details(self.page_list)
 
 
 class QueueHandler:
@@ -284,45 +636,70 @@ class QueueHandler:
         self.ranks = ranks.RanksHandler()
         self.subscriptions = json.load(open(config.subscriptions_filepath, mode='r'))
         self.channel_details = self.subscriptions['details']
-        self.records = Records()
+        self.records = get_records()
         days_to_search = config.variables['DAYS_TO_SEARCH']
+        self.scan_workers = config.variables['SCAN_WORKERS']
+        self.low_priority_ranks = config.variables['QUOTA_LOW_PRIORITY_RANKS']
         self.date_format = config.variables['YOUTUBE_DATE_FORMAT']
         self.oldest_date = datetime.now() - timedelta(days=days_to_search)
         logger.write(self.oldest_date.strftime(config.variables['EVENT_LOG_FORMAT']))
 
-    def scan_ordered_channels(self, rank_order=None):
+    def scan_ordered_channels(self, rank_order=None, engine='threads'):
         if rank_order is None:
             rank_order = ['f1', 'primary', 'secondary']
         channel_names = []
-        rank_data = self.ranks.define_ranks()
+        channel_priorities = {}
         for rank in rank_order:
             logger.write("Scanning %s" % rank)
-            for rank_block in rank_data:
-                if rank_block.name == rank:
-                    channel_names += rank_block.get_channels()
+            priority = quota.LOW if rank in self.low_priority_ranks else quota.NORMAL
+            for channel_name in self.ranks.tier_channels(rank):
+                channel_names.append(channel_name)
+                if channel_name not in channel_priorities:
+                    channel_priorities[channel_name] = priority
 
-        self.scan_channels(channel_names=channel_names)
+        self.scan_channels(channel_names=channel_names, channel_priorities=channel_priorities, engine=engine)
 
-    def scan_channels(self, all_videos=False, channel_names=None):
-        def find_tier_queue_id(channel):
-            tier_name = ""
-            handler = self.ranks
-            handler.define_ranks()
-            for tier in handler.rank_data:
-                tier_name = tier.name
-                tier_channels = tier.get_channels()
-                if channel in tier_channels:
-                    break
+    def scan_channels(self, all_videos=False, channel_names=None, channel_priorities=None, engine='threads'):
+        added_to_queue = []
+        metrics.set_phase("scan")
+        if engine == 'asyncio':
+            from handlers import aio
+
+            scanners = self.build_scanners(all_videos, channel_names, channel_priorities)
+            logger.write("Scanning %i channels with the asyncio engine" % len(scanners))
+            errors = aio.AsyncScanner().run(scanners)
+        else:
+            pool = workers.get_pool("scan", self.scan_workers)
+            scanners = self.build_scanners(all_videos, channel_names, channel_priorities, pool=pool)
+            logger.write("Scanning %i channels with %i workers" % (len(scanners), self.scan_workers))
+            for scanner in scanners:
+                scanner.start()
+
+            errors = pool.wait()
+        logger.write("All scans done. Failed tasks: %i" % len(errors))
+
+        for scanner in scanners:
+            added_to_queue += scanner.added_to_queue
 
-            if tier_name not in handler.queues:
+        if len(added_to_queue) > 0:
+            logger.write("Added to queue:")
+            for vid_data in added_to_queue:
+                logger.write("\t- %s: %s" % (vid_data['snippet']['channelTitle'], vid_data['snippet']['title']))
+                # self.records.add_record(vid_data)
+
+        self.records.compact()
+        cache.get_response_cache().write()
+
+    def build_scanners(self, all_videos=False, channel_names=None, channel_priorities=None, pool=None):
+        def find_tier_queue_id(channel):
+            entry = self.ranks.channel_entry(channel)
+            if entry['default']:
                 logger.write("- %s: default" % channel)
-                return handler.queues['queue']
             else:
-                logger.write("- %s: %s" % (channel, tier_name))
-                return handler.queues[tier_name]
+                logger.write("- %s: %s" % (channel, entry['tier']))
+            return entry['queue_id']
 
-        added_to_queue = []
-        threads = []
+        scanners = []
         if channel_names is None:
             channel_details = self.channel_details
         else:
@@ -331,7 +708,6 @@ class QueueHandler:
                 if channel_name in self.channel_details:
                     channel_details[channel_name] = self.channel_details[channel_name]
 
-        batch = []
         for channel_name in channel_details:
             tier_queue_id = find_tier_queue_id(channel_name)
             if tier_queue_id is None:
@@ -339,51 +715,27 @@ class QueueHandler:
 
             kwargs = channel_details[channel_name]
             kwargs['name'] = channel_name
-            if not self.ranks.channel_filtered(channel_id=kwargs['id']):
+            # Full-history scans are deferred first once the daily quota runs low
+            if all_videos:
+                kwargs['priority'] = quota.LOW
+            elif channel_priorities is not None and channel_name in channel_priorities:
+                kwargs['priority'] = channel_priorities[channel_name]
+            else:
+                kwargs['priority'] = quota.NORMAL
+            if not self.ranks.channel_entry(channel_name)['filtered']:
                 # added_to_queue = added_to_queue + self.scan_channel(all=all_videos, **kwargs)
-                thread_kwargs = {
+                scanner_kwargs = {
                     "queue_id": tier_queue_id,
                     "name": channel_name,
                     "oldest_date": self.oldest_date,
                     "records": self.records,
                     "channel_kwargs": kwargs,
-                    "all": all_videos
+                    "all": all_videos,
+                    "pool": pool
                 }
-                batch.append(ChannelScanner(**thread_kwargs))
-            if len(batch) > 10:
-                threads.append(batch.copy())
-                batch = []
-                logger.write("Batch %i written" % len(threads))
-        threads.append(batch.copy())
-        logger.write("Batch %i written" % len(threads))
-
-        batch_count = 0
-        for batch in threads:
-            logger.write("Processing Batch %i" % batch_count)
-            for thread in batch:
-                logger.write("- %s" % thread.name)
-
-            for thread in batch:
-                thread.start()
-                sleep(0.1)
-
-            for thread in batch:
-                thread.join()
-
-            logger.write("\n\n\n")
+                scanners.append(ChannelScanner(**scanner_kwargs))
 
-            batch_count += 1
-            logger.write("All batches done.")
-
-        for batch in threads:
-            for thread in batch:
-                added_to_queue += thread.added_to_queue
-
-        if len(added_to_queue) > 0:
-            logger.write("Added to queue:")
-            for vid_data in added_to_queue:
-                logger.write("\t- %s: %s" % (vid_data['snippet']['channelTitle'], vid_data['snippet']['title']))
-                # self.records.add_record(vid_data)
+        return scanners
 
     def scan_channel(self, all=False, **kwargs):
         channel = SubscribedChannel(**kwargs)
@@ -406,13 +758,15 @@ class QueueHandler:
 
     def vid_is_valid(self, record):
         if record['publishedAt'] > self.oldest_date:
-            if record['videoId'] not in self.records.channel_vids_added(record['channelId']):
+            if not self.records.vid_added(record['videoId'], record['channelId']):
                 return True
             else:
                 return False
         return False
 
     def add_video_to_queue(self, vid_data):
+        import googleapiclient.errors
+
         youtube = client.YoutubeClientHandler()
         body = {
             'snippet': {
@@ -439,9 +793,8 @@ class QueueHandler:
         return response
 
 
-class ChannelScanner(threading.Thread):
-    def __init__(self, queue_id, name, oldest_date, records, channel_kwargs, all):
-        super().__init__()
+class ChannelScanner:
+    def __init__(self, queue_id, name, oldest_date, records, channel_kwargs, all, pool=None):
         self.queue_id = queue_id
         self.name = name
         self.added_to_queue = []
@@ -449,41 +802,94 @@ class ChannelScanner(threading.Thread):
         self.records = records
         self.channel_kwargs = channel_kwargs
         channel_kwargs['oldest_date'] = self.oldest_date
+        self.priority = channel_kwargs['priority'] if 'priority' in channel_kwargs else quota.NORMAL
         self.all = all
+        self.pool = pool
+        self.channel = None
+        self.lock = threading.Lock()
+        self.results = []
+        self.pending_pages = 0
+
+    def start(self):
+        self.pool.submit(self.scan_uploads)
+
+    def scan_uploads(self):
+        logger.write("Starting scan: %s" % self.name)
+        self.channel = SubscribedChannel(**self.channel_kwargs)
+        items = self.channel.get_uploads(all=self.all)
+        pages = self.channel.detail_pages(items)
+        if len(pages) == 0:
+            self.finish()
+            return
+
+        self.pending_pages = len(pages)
+        for page_num, page_list in enumerate(pages):
+            self.pool.submit(self.fetch_page, page_num, page_list)
+
+    def fetch_page(self, page_num, page_list):
+        items = []
+        try:
+            items = self.channel.get_details(page_list)
+        except Exception as e:
+            logger.write("Failed to get details: %s Page %i (%i videos): %s" % (
+                self.name, page_num, len(page_list), repr(e)))
+            raise
+        finally:
+            with self.lock:
+                self.results += items
+                self.pending_pages -= 1
+                done = self.pending_pages == 0
+            # The pages that did download are still queued; a failed page's videos stay
+            # unrecorded, so the next scan picks them up again
+            if done:
+                self.finish()
+
+    def finish(self):
+        self.channel.set_newest(self.results)
+        self.queue_videos()
 
     def run(self):
-        logger.write("Starting thread: %s" % self.name)
-        channel = SubscribedChannel(**self.channel_kwargs)
-        channel.get_latest(all=self.all)
+        logger.write("Starting scan: %s" % self.name)
+        self.channel = SubscribedChannel(**self.channel_kwargs)
+        self.channel.get_latest(all=self.all)
+
+        return self.queue_videos()
+
+    def queue_videos(self):
         self.added_to_queue = []
-        for vid_data in channel.newest:
-            record = {
-                'videoId': vid_data['id'],
-                'publishedAt': vid_data['snippet']['publishedAt'],
-                'channelId': vid_data['snippet']['channelId'],
-                'channelTitle': vid_data['snippet']['channelTitle'],
-                'title': vid_data['snippet']['title']
-            }
+        for vid_data in self.channel.newest:
+            if self.should_queue(vid_data):
+                try:
+                    response = self.add_video_to_queue(vid_data)
+                except (quota.QuotaDeferred, quota.QuotaExhausted) as e:
+                    # Every later insert would be refused too; the videos stay unrecorded for the next scan
+                    logger.write("Stopped queuing %s: %s" % (self.name, e))
+                    break
+                if response is not None:
+                    self.added_to_queue.append(vid_data)
 
-            if 'liveBroadcastContent' in vid_data['snippet']:
-                record['liveBroadcastContent'] = vid_data['snippet']['liveBroadcastContent']
+        return self.added_to_queue
 
-            valid = self.vid_is_valid(record)
-            if valid:
-                fp = open('./logs/snippets.log', mode='a')
-                tmp_vid_data = copy.deepcopy(vid_data)
-                tmp_vid_data['snippet']['publishedAt'] = tmp_vid_data['snippet']['publishedAt'].strftime("%Y-%m-%dT%H:%M:%S.%f")
-                utilities.print_json(tmp_vid_data, fp)
-                fp.close()
+    def should_queue(self, vid_data):
+        record = {
+            'videoId': vid_data['id'],
+            'publishedAt': vid_data['snippet']['publishedAt'],
+            'channelId': vid_data['snippet']['channelId'],
+            'channelTitle': vid_data['snippet']['channelTitle'],
+            'title': vid_data['snippet']['title']
+        }
 
-                self.add_video_to_queue(vid_data)
-                self.added_to_queue.append(vid_data)
+        if 'liveBroadcastContent' in vid_data['snippet']:
+            record['liveBroadcastContent'] = vid_data['snippet']['liveBroadcastContent']
 
-        return self.added_to_queue
+        valid = self.vid_is_valid(record)
+        if valid:
+            snippets.get_snippet_log().write(vid_data)
 
-    def add_video_to_queue(self, vid_data):
-        youtube = client.YoutubeClientHandler()
-        body = {
+        return valid
+
+    def queue_body(self, vid_data):
+        return {
             'snippet': {
                 'playlistId': self.queue_id,
                 'resourceId': {
@@ -492,25 +898,29 @@ class ChannelScanner(threading.Thread):
                 }
             }
         }
+
+    def add_video_to_queue(self, vid_data):
+        import googleapiclient.errors
+
+        youtube = client.YoutubeClientHandler()
+        body = self.queue_body(vid_data)
         try:
             logger.write(
                 "Adding to queue: %s - %s" % (vid_data['snippet']['channelTitle'], vid_data['snippet']['title']))
             request = youtube.client.playlistItems().insert(part='snippet', body=body)
-            response = youtube.execute(request)
+            response = youtube.execute(request, self.priority)
             self.records.add_record(vid_data=vid_data)
         except googleapiclient.errors.HttpError as e:
-            print(e.content)
-            print(e.error_details)
-            print(e.resp)
-            raise
-        except:
-            raise
+            # Retries are exhausted; leave the video unrecorded so the next scan picks it up again
+            logger.write("Failed to add to queue: %s - %s: %s" % (
+                vid_data['snippet']['channelTitle'], vid_data['snippet']['title'], e))
+            return None
 
         return response
 
     def vid_is_valid(self, record):
         if record['publishedAt'] > self.oldest_date:
-            if record['videoId'] not in self.records.channel_vids_added(record['channelId']):
+            if not self.records.vid_added(record['videoId'], record['channelId']):
                 tmp_record = {
                     'title': record['title'],
                     'channelTitle': record['channelTitle']
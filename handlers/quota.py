@@ -0,0 +1,130 @@
+from handlers.utilities import ConfigHandler
+from datetime import datetime
+from time import monotonic
+import atexit
+import json
+import os
+import threading
+import pytz
+
+NORMAL = 'normal'
+LOW = 'low'
+
+# Units charged per call, by the last part of the API method ID (youtube.videos.list -> list)
+COSTS = {
+    'list': 1,
+    'insert': 50,
+    'update': 50,
+    'delete': 50
+}
+FLUSH_INTERVAL = 5
+HISTORY_DAYS = 31
+
+
+class QuotaDeferred(Exception):
+    pass
+
+
+class QuotaExhausted(Exception):
+    pass
+
+
+def cost_of(method_id):
+    action = method_id.split('.')[-1]
+    return COSTS[action] if action in COSTS else 1
+
+
+class QuotaLedger:
+    def __init__(self):
+        config = ConfigHandler()
+        self.filepath = config.quota_filepath
+        self.date_format = config.variables['DATE_FORMAT']
+        self.budget = config.variables['QUOTA_DAILY_BUDGET']
+        self.low_priority_limit = self.budget * config.variables['QUOTA_LOW_PRIORITY_THRESHOLD']
+        self.timezone = pytz.timezone(config.variables['QUOTA_TIMEZONE'])
+        self.lock = threading.Lock()
+        self.data = {}
+        self.pending = {}
+        self.last_flush = monotonic()
+        self.read()
+
+    def today(self):
+        # The API quota resets at midnight Pacific time
+        return datetime.now(self.timezone).strftime(self.date_format)
+
+    def read(self):
+        self.data = json.load(open(self.filepath, mode='r')) if os.path.exists(self.filepath) else {}
+
+    def usage(self, date=None):
+        date = self.today() if date is None else date
+        used = self.data[date]['total'] if date in self.data else 0
+        if date in self.pending:
+            used += self.pending[date]['total']
+
+        return used
+
+    def charge(self, method_ids, priority=NORMAL):
+        date = self.today()
+        cost = sum(cost_of(method_id) for method_id in method_ids)
+        with self.lock:
+            used = self.usage(date)
+            if used + cost > self.budget:
+                raise QuotaExhausted("%i of %i units used today; %s needs %i" % (
+                    used, self.budget, ",".join(method_ids), cost))
+            if priority == LOW and used >= self.low_priority_limit:
+                raise QuotaDeferred("%i of %i units used today; deferring low-priority %s" % (
+                    used, self.budget, ",".join(method_ids)))
+
+            if date not in self.pending:
+                self.pending[date] = {'total': 0, 'methods': {}}
+            day = self.pending[date]
+            for method_id in method_ids:
+                if method_id not in day['methods']:
+                    day['methods'][method_id] = {'calls': 0, 'units': 0}
+                day['methods'][method_id]['calls'] += 1
+                day['methods'][method_id]['units'] += cost_of(method_id)
+            day['total'] += cost
+
+            if monotonic() - self.last_flush > FLUSH_INTERVAL:
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        # Re-read first so totals charged by other processes since our last flush are kept
+        self.read()
+        for date in self.pending:
+            if date not in self.data:
+                self.data[date] = {'total': 0, 'methods': {}}
+            day = self.data[date]
+            day['total'] += self.pending[date]['total']
+            for method_id in self.pending[date]['methods']:
+                if method_id not in day['methods']:
+                    day['methods'][method_id] = {'calls': 0, 'units': 0}
+                for field in ['calls', 'units']:
+                    day['methods'][method_id][field] += self.pending[date]['methods'][method_id][field]
+        for date in sorted(self.data)[:-HISTORY_DAYS]:
+            del self.data[date]
+
+        tmp_filepath = self.filepath + ".tmp"
+        fp = open(tmp_filepath, mode='w')
+        json.dump(self.data, fp=fp, separators=(',', ': '), indent=2, sort_keys=True)
+        fp.close()
+        os.replace(tmp_filepath, self.filepath)
+        self.pending = {}
+        self.last_flush = monotonic()
+
+
+ledger = None
+ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global ledger
+    with ledger_lock:
+        if ledger is None:
+            ledger = QuotaLedger()
+            atexit.register(ledger.flush)
+    return ledger
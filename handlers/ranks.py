@@ -4,6 +4,13 @@ from copy import deepcopy
 import json, os
 
 logger = utilities.Logger()
+
+
+def file_version(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
 class Tier:
     def __init__(self, **kwargs):
         self.name = kwargs['tier']
@@ -42,7 +49,7 @@ class Tier:
     def get_channel_data(self):
         self.channel_data = []
         config = utilities.ConfigHandler()
-        subscriptions = json.load(open(config.subscriptions_filepath, mode='r'))['details']
+        subscriptions = utilities.load_json(config.subscriptions_filepath)['details']
 
         for channel_name in self.channels:
             if channel_name in subscriptions:
@@ -124,16 +131,21 @@ class RanksHandler():
         self.data = json.load(open(config.ranks_filepath, mode='r'))
         self.ranks = self.data['ranks']
         self.filtered = self.data['filters']
-        self.filtered_channels = []
+        self.filtered_channels = set()
         for channel_name in self.filtered['channels']:
-            self.filtered_channels.append(self.filtered['channels'][channel_name])
+            self.filtered_channels.add(self.filtered['channels'][channel_name])
         self.playlists = self.data['playlist_ids']
         self.queues = self.data['queues']
         for tier in config.variables['TIER_PLAYLISTS']:
             self.playlists[tier] = config.variables['TIER_PLAYLISTS'][tier]
+        self.ranks_filepath = config.ranks_filepath
+        self.subscriptions_filepath = config.subscriptions_filepath
+        self.index_filepath = config.rank_index_filepath
         self.rank_data = []
+        self.index = None
 
     def define_ranks(self):
+        self.rank_data = []
         for rank_block in self.ranks:
             if 'playlist' not in rank_block:
                 rank_block['playlist'] = 'watch_later'
@@ -142,6 +154,96 @@ class RanksHandler():
 
         return self.rank_data
 
+    def get_index(self):
+        if self.index is None:
+            self.index = self.load_index()
+
+        return self.index
+
+    def load_index(self):
+        # The compiled index is reused until ranks.json or subscriptions.json changes
+        source = {
+            'ranks': file_version(self.ranks_filepath),
+            'subscriptions': file_version(self.subscriptions_filepath)
+        }
+        if os.path.exists(self.index_filepath):
+            try:
+                index = json.load(open(self.index_filepath, mode='r'))
+                if index['source'] == source:
+                    return index
+            except (ValueError, KeyError):
+                pass
+
+        index = self.compile_index()
+        index['source'] = source
+        tmp_filepath = self.index_filepath + ".tmp"
+        fp = open(tmp_filepath, mode='w')
+        json.dump(index, fp=fp, separators=(',', ':'))
+        fp.close()
+        os.replace(tmp_filepath, self.index_filepath)
+
+        return index
+
+    def compile_index(self):
+        # channel name -> the first top-level tier listing it anywhere in its subtiers,
+        # that tier's queue playlist, and whether the channel is filtered
+        def collect(rank_block):
+            channels = list(rank_block['channels']) if 'channels' in rank_block else []
+            for subtier in rank_block['subtiers'] if 'subtiers' in rank_block else []:
+                channels += collect(subtier)
+            return channels
+
+        subscriptions = utilities.load_json(self.subscriptions_filepath)['details']
+        tiers = {}
+        channels = {}
+        ids = {}
+        default_tier = ""
+        for rank_block in self.ranks:
+            tier_name = rank_block['tier']
+            tier_channels = collect(rank_block)
+            tiers[tier_name] = tiers[tier_name] + tier_channels if tier_name in tiers else tier_channels
+            for channel_name in tier_channels:
+                if channel_name not in channels:
+                    channels[channel_name] = {'tier': tier_name}
+            default_tier = tier_name
+
+        # Channels in no tier fall through to the last one, as the tier scan always did
+        for channel_name in subscriptions:
+            if channel_name not in channels:
+                channels[channel_name] = {'tier': default_tier}
+        for channel_name in channels:
+            entry = channels[channel_name]
+            entry['queue_id'] = self.queues[entry['tier']] if entry['tier'] in self.queues else self.queues['queue']
+            entry['default'] = entry['tier'] not in self.queues
+            channel_id = subscriptions[channel_name]['id'] if channel_name in subscriptions else None
+            entry['id'] = channel_id
+            entry['filtered'] = channel_id in self.filtered_channels
+            if channel_id is not None:
+                ids[channel_id] = channel_name
+
+        return {'tiers': tiers, 'channels': channels, 'ids': ids, 'default_tier': default_tier}
+
+    def channel_entry(self, channel):
+        # Accepts a channel name or ID
+        index = self.get_index()
+        if channel in index['ids']:
+            channel = index['ids'][channel]
+        if channel in index['channels']:
+            return index['channels'][channel]
+
+        tier_name = index['default_tier']
+        return {
+            'tier': tier_name,
+            'queue_id': self.queues[tier_name] if tier_name in self.queues else self.queues['queue'],
+            'default': tier_name not in self.queues,
+            'id': None,
+            'filtered': channel in self.filtered_channels
+        }
+
+    def tier_channels(self, tier_name):
+        index = self.get_index()
+        return index['tiers'][tier_name] if tier_name in index['tiers'] else []
+
     def channel_filtered(self, channel_id):
         if channel_id in self.filtered_channels:
             return True
@@ -0,0 +1,69 @@
+from bisect import bisect_left
+
+KEEP = 'keep'
+UPDATE = 'update'
+INSERT = 'insert'
+
+
+def longest_increasing_subsequence(values):
+    # Patience sorting; returns the indices into values of one longest strictly increasing run
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        slot = bisect_left(tails, value)
+        if slot > 0:
+            previous[index] = tail_indices[slot - 1]
+        if slot == len(tails):
+            tails.append(value)
+            tail_indices.append(index)
+        else:
+            tails[slot] = value
+            tail_indices[slot] = index
+
+    sequence = []
+    index = tail_indices[-1] if len(tail_indices) > 0 else None
+    while index is not None:
+        sequence.append(index)
+        index = previous[index]
+
+    return sequence[::-1]
+
+
+def plan_reorder(current_order, desired, target_playlist_id):
+    # current_order: playlistItemIds in the target playlist, in their current order
+    # desired: items in the order they should end up, each with a sourcePlaylistId and playlistItemId
+    # Items already in the target that form the longest increasing run of current
+    # positions stay put; every other item is placed directly after its predecessor.
+    state = list(current_order)
+    current_positions = {}
+    for position, playlist_item_id in enumerate(state):
+        current_positions[playlist_item_id] = position
+
+    in_target = []
+    for index, item in enumerate(desired):
+        if item['sourcePlaylistId'] == target_playlist_id and item['playlistItemId'] in current_positions:
+            in_target.append(index)
+    run = longest_increasing_subsequence([current_positions[desired[i]['playlistItemId']] for i in in_target])
+    kept = set(in_target[i] for i in run)
+
+    steps = []
+    previous_key = None
+    for index, item in enumerate(desired):
+        if index in kept:
+            key = item['playlistItemId']
+            steps.append({'action': KEEP, 'item': item, 'position': None})
+        else:
+            if item['sourcePlaylistId'] == target_playlist_id and item['playlistItemId'] in current_positions:
+                key = item['playlistItemId']
+                state.remove(key)
+                action = UPDATE
+            else:
+                key = (INSERT, index)
+                action = INSERT
+            position = state.index(previous_key) + 1 if previous_key is not None else 0
+            state.insert(position, key)
+            steps.append({'action': action, 'item': item, 'position': position})
+        previous_key = key
+
+    return steps
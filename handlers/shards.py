@@ -0,0 +1,153 @@
+from datetime import datetime
+from os import path
+import json
+import os
+
+# Dates that are not real dates (e.g. previously_added) share one shard that is always loaded
+UNDATED = 'undated'
+INDEX_FILE = "index.json"
+
+
+def fsync_directory(dirpath):
+    # Makes a rename durable; not every platform can open a directory
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(filepath, text):
+    tmp_filepath = filepath + ".tmp"
+    fp = open(tmp_filepath, mode='w', encoding="utf-8")
+    fp.write(text)
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+    os.replace(tmp_filepath, filepath)
+
+
+class RecordShards:
+    # Records of queued videos, kept as dates[date][channelId][videoId] like records.json but
+    # split into one file per period of the queue date. The index lists every shard with the
+    # range of dates it holds and carries the per-channel watermarks, so a process only has to
+    # read the shards that overlap the window it dedupes against.
+    def __init__(self, directory, date_format, shard_format):
+        self.directory = directory
+        self.index_filepath = path.join(directory, INDEX_FILE)
+        self.date_format = date_format
+        self.shard_format = shard_format
+        self.dates = {}
+        self.latest = {}
+        self.shards = {}
+        self.loaded = set()
+        self.dirty = set()
+        if path.exists(self.index_filepath):
+            fp = open(self.index_filepath, mode='r', encoding="utf-8")
+            index = json.load(fp)
+            fp.close()
+            self.shards = index['shards']
+            self.latest = index['latest']
+
+    def exists(self):
+        return path.exists(self.index_filepath)
+
+    def parse_date(self, date):
+        try:
+            return datetime.strptime(date, self.date_format)
+        except ValueError:
+            return None
+
+    def shard_key(self, date):
+        parsed = self.parse_date(date)
+        return UNDATED if parsed is None else parsed.strftime(self.shard_format)
+
+    def load(self, key):
+        # Returns the dates read, so the caller can index them
+        if key in self.loaded:
+            return {}
+        self.loaded.add(key)
+        if key not in self.shards:
+            return {}
+
+        fp = open(path.join(self.directory, self.shards[key]['file']), mode='r', encoding="utf-8")
+        dates = json.load(fp)
+        fp.close()
+        for date in dates:
+            if date in self.dates:
+                # Entries applied before the shard was read (from the journal) are newer
+                for channel_id in self.dates[date]:
+                    dates[date].setdefault(channel_id, {}).update(self.dates[date][channel_id])
+            self.dates[date] = dates[date]
+
+        return dates
+
+    def load_since(self, since):
+        loaded = {}
+        for key in sorted(self.shards, reverse=True):
+            last = self.shards[key]['last']
+            if key == UNDATED or last is None or last >= since.strftime("%Y-%m-%d"):
+                loaded.update(self.load(key))
+
+        return loaded
+
+    def load_all(self):
+        loaded = {}
+        for key in sorted(self.shards):
+            loaded.update(self.load(key))
+
+        return loaded
+
+    def video_ids(self):
+        # Reads unloaded shards one at a time without keeping them
+        for key in sorted(self.shards):
+            if key in self.loaded:
+                dates = dict((date, self.dates[date]) for date in self.dates if self.shard_key(date) == key)
+            else:
+                fp = open(path.join(self.directory, self.shards[key]['file']), mode='r', encoding="utf-8")
+                dates = json.load(fp)
+                fp.close()
+            for date in dates:
+                for channel_id in dates[date]:
+                    for vid_id in dates[date][channel_id]:
+                        yield vid_id
+
+    def touch(self, date):
+        # A shard must be read in full before it is rewritten, or older entries would be lost
+        key = self.shard_key(date)
+        loaded = self.load(key)
+        self.dirty.add(key)
+
+        return loaded
+
+    def serialise(self):
+        # Returns the files to write, shards first and the index last
+        files = []
+        for key in sorted(self.dirty):
+            dates = dict((date, self.dates[date]) for date in self.dates if self.shard_key(date) == key)
+            parsed = sorted(self.parse_date(date) for date in dates if self.parse_date(date) is not None)
+            self.shards[key] = {
+                'file': "%s.json" % key,
+                'first': parsed[0].strftime("%Y-%m-%d") if len(parsed) > 0 else None,
+                'last': parsed[-1].strftime("%Y-%m-%d") if len(parsed) > 0 else None,
+                'videos': sum(len(dates[date][channel_id]) for date in dates for channel_id in dates[date])
+            }
+            files.append((path.join(self.directory, self.shards[key]['file']),
+                          json.dumps(dates, separators=(',', ':'), sort_keys=True) + "\n"))
+        self.dirty = set()
+        files.append((self.index_filepath, json.dumps({'shards': self.shards, 'latest': self.latest},
+                                                      separators=(',', ': '), indent=2, sort_keys=True) + "\n"))
+
+        return files
+
+    def write(self, files):
+        if not path.exists(self.directory):
+            os.makedirs(self.directory)
+        for filepath, text in files:
+            write_atomic(filepath, text)
+        fsync_directory(self.directory)
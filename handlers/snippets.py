@@ -0,0 +1,43 @@
+from handlers.utilities import ConfigHandler, get_log_sink
+from datetime import datetime
+from os import path
+import json
+import random
+import threading
+
+
+def encode(value):
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    raise TypeError("%s is not JSON serializable" % type(value).__name__)
+
+
+class SnippetLog:
+    # Raw API responses for queued videos, one compact JSON line each
+    def __init__(self):
+        config = ConfigHandler()
+        self.enabled = config.variables['SNIPPETS_ENABLED']
+        self.sample_rate = config.variables['SNIPPETS_SAMPLE_RATE']
+        self.filepath = path.join(config.log_path, config.variables['SNIPPETS_FILE'])
+        self.max_bytes = config.variables['SNIPPETS_MAX_BYTES']
+
+    def write(self, vid_data):
+        if not self.enabled:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        line = json.dumps(vid_data, separators=(',', ':'), default=encode)
+        get_log_sink(self.filepath, max_bytes=self.max_bytes).write(line)
+
+
+snippet_log = None
+snippet_log_lock = threading.Lock()
+
+
+def get_snippet_log():
+    global snippet_log
+    with snippet_log_lock:
+        if snippet_log is None:
+            snippet_log = SnippetLog()
+    return snippet_log
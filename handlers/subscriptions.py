@@ -1,4 +1,4 @@
-from handlers import playlist, utilities
+from handlers import metrics, playlist, utilities
 from handlers.utilities import ConfigHandler
 from handlers.client import YoutubeClientHandler
 from handlers.ranks import RanksHandler
@@ -15,7 +15,8 @@ class SubscriptionsHandler:
         self.subscriptions = json.load(open(self.config.subscriptions_filepath, mode='r'))
         self.current = deepcopy(self.subscriptions)
         self.old = {}
-        self.client = YoutubeClientHandler().client
+        self.youtube = YoutubeClientHandler()
+        self.client = self.youtube.client
         self.raw = []
         self.changes = {
             'removed': [],
@@ -25,6 +26,7 @@ class SubscriptionsHandler:
 
     def fetch_subs(self):
         logger.write("Fetching subscriptions")
+        metrics.set_phase("subscriptions")
         kwargs = {
             'part': 'snippet',
             'channelId': 'UCWW8SlHj1Ax0iGE3uJGnNrw',
@@ -41,7 +43,7 @@ class SubscriptionsHandler:
             logger.write("\tFetching page {0}".format(page))
             titles[page] = []
             request = self.client.subscriptions().list(**kwargs)
-            response = request.execute()
+            response = self.youtube.execute(request)
             for item in response['items']:
                 results.append(item)
             if 'nextPageToken' in response:
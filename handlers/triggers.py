@@ -0,0 +1,87 @@
+from handlers.utilities import Logger
+from os import path
+from time import sleep
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+logger = Logger()
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 65536
+
+
+class InotifyWatcher:
+    # Sleeps in the kernel until a trigger file appears in one of the directories
+    def __init__(self, directories, names):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.names = set(names)
+        self.watches = {}
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, "inotify_add_watch failed: %s" % directory)
+            self.watches[wd] = directory
+
+    def wait(self, timeout=None):
+        # Returns the trigger paths touched, or an empty list once the timeout passes
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        found = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            start = offset + EVENT_HEADER.size
+            name = os.fsdecode(data[start:start + length].rstrip(b"\0"))
+            offset = start + length
+            if wd in self.watches and name in self.names:
+                found.append(path.join(self.watches[wd], name))
+
+        return found
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # For platforms without inotify: one stat per trigger path per interval
+    def __init__(self, directories, names, interval):
+        self.paths = [path.join(directory, name) for directory in directories for name in names]
+        self.interval = interval
+
+    def wait(self, timeout=None):
+        sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+        return [filepath for filepath in self.paths if path.exists(filepath)]
+
+    def close(self):
+        pass
+
+
+def get_watcher(directories, names, interval):
+    try:
+        return InotifyWatcher(directories, names)
+    except (AttributeError, OSError) as e:
+        logger.write("inotify unavailable (%s); polling every %ss" % (e, interval))
+        return PollingWatcher(directories, names, interval)
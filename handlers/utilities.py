@@ -1,9 +1,71 @@
 from datetime import datetime
+from time import monotonic
+from types import MappingProxyType
+import atexit
+import gzip
 import json
+import queue
 import shutil
 import os
+import threading
 from os import path
 
+# Seconds between mtime checks of a cached file
+RELOAD_INTERVAL = 1
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType(dict((key, freeze(value[key])) for key in value))
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, MappingProxyType):
+        return dict((key, thaw(value[key])) for key in value)
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class FileSnapshot:
+    def __init__(self, filepath, version):
+        self.filepath = filepath
+        self.version = version
+        fp = open(filepath, mode='r')
+        self.data = freeze(json.load(fp))
+        fp.close()
+
+
+snapshots = {}
+snapshots_lock = threading.Lock()
+
+
+def load_json(filepath):
+    # Parsed JSON shared by every caller in the process, re-read only once the file's mtime
+    # or size changes. The result is frozen; thaw() it for a private, mutable copy.
+    now = monotonic()
+    with snapshots_lock:
+        snapshot, checked = snapshots[filepath] if filepath in snapshots else (None, 0)
+    if snapshot is not None and now - checked < RELOAD_INTERVAL:
+        return snapshot.data
+
+    stat = os.stat(filepath)
+    version = (stat.st_mtime_ns, stat.st_size)
+    if snapshot is None or snapshot.version != version:
+        try:
+            snapshot = FileSnapshot(filepath, version)
+        except ValueError:
+            # Caught mid-write; keep serving the last good version if there is one
+            if snapshot is None:
+                raise
+    with snapshots_lock:
+        snapshots[filepath] = (snapshot, now)
+
+    return snapshot.data
+
 
 class ConfigHandler:
     def __init__(self, cwd=None, config_file="config.json"):
@@ -17,21 +79,25 @@ class ConfigHandler:
         self.log_path = path.join(self.home, 'logs')
         self.secrets_filepath = path.join(self.home, self.variables['CLIENT_SECRETS_FILE'])
         self.records_filepath = path.join(self.home, self.variables['RECORDS_FILE'])
+        self.records_dirpath = path.join(self.home, self.variables['RECORDS_DIR'])
         self.ranks_filepath = path.join(self.home, self.variables['RANKS_FILE'])
         self.subscriptions_filepath = path.join(self.home, self.variables['SUBSCRIPTIONS_FILE'])
         self.private_videos_filepath = path.join(self.home, self.variables['PRIVATE_VIDEOS_FILE'])
+        self.quota_filepath = path.join(self.home, self.variables['QUOTA_FILE'])
+        self.etag_cache_filepath = path.join(self.home, self.variables['ETAG_CACHE_FILE'])
+        self.video_cache_filepath = path.join(self.home, self.variables['VIDEO_CACHE_FILE'])
+        self.discovery_cache_filepath = path.join(self.home, self.variables['DISCOVERY_CACHE_FILE'])
+        self.rank_index_filepath = path.join(self.home, self.variables['RANK_INDEX_FILE'])
         self.log_filepath = path.join(self.log_path, 'current.log')
 
     def read_config_file(self, config_file=None):
         if config_file is None:
             config_file = self.config_file
 
-        config_fp = open(config_file)
-        self.variables = json.load(config_fp)
-        config_fp.close()
+        self.variables = load_json(config_file)
 
     def print_config_file(self):
-        print_json(self.variables)
+        print_json(thaw(self.variables))
 
 
 class Logger:
@@ -42,26 +108,14 @@ class Logger:
         self.format = self.config.variables['EVENT_LOG_FORMAT']
 
     def initialize(self):
-        fp = open(self.file, mode='w')
-        fp.close()
-        message = LogMessage(
-            msg="Starting new logfile",
-            event_time_format=self.format,
-            logfile=self.file,
-            silent=self.silent
-        )
-        message.write()
+        get_log_sink(self.file).rotate()
+        self.write("Starting new logfile")
 
     def rename(self):
-        log_date = datetime.now()
-        file_suffix_format = self.config.variables['LOG_DATE_FORMAT']
-        file_suffix = log_date.strftime(file_suffix_format)
-        if log_date.hour == 0 and log_date.minute == 0 and log_date.second == 0:
-            shutil.copyfile(self.file, ".".join([self.file,file_suffix]))
-            self.initialize()
+        # Kept for callers of the old API; the sink rotates by size and day on its own
+        pass
 
     def write(self, msg=""):
-        self.rename()
         message = LogMessage(
             msg=msg,
             event_time_format=self.format,
@@ -80,12 +134,150 @@ class LogMessage:
         self.silent = silent
 
     def write(self):
-        fp = open(self.logfile, mode='a', encoding="utf-8")
-        print(": ".join([self.event_time, self.msg]), file=fp)
-        fp.close()
+        get_log_sink(self.logfile).write(": ".join([self.event_time, self.msg]), silent=self.silent)
 
-        if not self.silent:
-            print(": ".join([self.event_time, self.msg]).encode("utf-8"))
+
+class LogSink:
+    # One writer thread per log file: callers only enqueue, so lines never interleave and
+    # the file is opened once rather than per message.
+    def __init__(self, filepath, max_bytes=None):
+        config = ConfigHandler()
+        self.filepath = filepath
+        self.max_bytes = config.variables['LOG_MAX_BYTES'] if max_bytes is None else max_bytes
+        self.compress = config.variables['LOG_COMPRESS']
+        self.flush_interval = config.variables['LOG_FLUSH_INTERVAL']
+        self.batch_size = config.variables['LOG_BATCH_SIZE']
+        self.suffix_format = config.variables['LOG_DATE_FORMAT']
+        self.queue = queue.Queue()
+        self.fp = None
+        self.size = 0
+        self.day = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, line, silent=True):
+        self.queue.put((line, silent))
+
+    def rotate(self):
+        self.queue.put(ROTATE)
+
+    def flush(self):
+        # Blocks until everything enqueued before this call is on disk
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif item is ROTATE:
+                    self.write_lines(lines)
+                    lines = []
+                    self.rotate_file()
+                elif isinstance(item, threading.Event):
+                    self.write_lines(lines)
+                    lines = []
+                    item.set()
+                else:
+                    lines.append(item)
+            self.write_lines(lines)
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def write_lines(self, lines):
+        if len(lines) == 0:
+            return
+        text = "".join(line + "\n" for line, silent in lines)
+        data = text.encode('utf-8')
+        today = datetime.now().date()
+        if self.fp is None:
+            self.open_file()
+        if self.day != today or (self.size > 0 and self.size + len(data) > self.max_bytes):
+            self.rotate_file()
+
+        self.fp.write(data)
+        self.fp.flush()
+        self.size += len(data)
+        for line, silent in lines:
+            if not silent:
+                print(line.encode('utf-8'))
+
+    def open_file(self):
+        if not path.exists(path.dirname(self.filepath)):
+            os.makedirs(path.dirname(self.filepath))
+        self.fp = open(self.filepath, mode='ab')
+        self.size = self.fp.tell()
+        # An existing log belongs to the day it was last written
+        self.day = datetime.fromtimestamp(os.path.getmtime(self.filepath)).date() if self.size > 0 \
+            else datetime.now().date()
+
+    def rotate_file(self):
+        if self.fp is not None:
+            self.fp.close()
+        if path.exists(self.filepath) and path.getsize(self.filepath) > 0:
+            rotated = ".".join([self.filepath, datetime.now().strftime(self.suffix_format)])
+            counter = 1
+            while path.exists(rotated) or path.exists(rotated + ".gz"):
+                rotated = ".".join([self.filepath, datetime.now().strftime(self.suffix_format), str(counter)])
+                counter += 1
+            os.replace(self.filepath, rotated)
+            if self.compress:
+                with open(rotated, mode='rb') as source, gzip.open(rotated + ".gz", mode='wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(rotated)
+        self.fp = open(self.filepath, mode='ab')
+        self.size = 0
+        self.day = datetime.now().date()
+
+
+ROTATE = object()
+log_sinks = {}
+log_sinks_lock = threading.Lock()
+
+
+def file_versions(filepaths):
+    # (mtime, size) per file, None for a missing one; compared to notice writes by other processes
+    versions = []
+    for filepath in filepaths:
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            versions.append(None)
+            continue
+        versions.append((stat.st_mtime_ns, stat.st_size))
+
+    return tuple(versions)
+
+
+def get_log_sink(filepath, max_bytes=None):
+    with log_sinks_lock:
+        if filepath not in log_sinks:
+            log_sinks[filepath] = LogSink(filepath, max_bytes=max_bytes)
+            atexit.register(log_sinks[filepath].close)
+        return log_sinks[filepath]
 
 
 def print_json(obj, fp=None):
@@ -98,40 +290,6 @@ def print_json(obj, fp=None):
 
 
 def log(msg, silent=False):
-    try:
-        config = ConfigHandler()
-        log_date_format = config.variables['LOG_DATE_FORMAT']
-        log_file = config.log_filepath
-        log_date = datetime.now()
-        log_date_formatted = log_date.strftime(log_date_format)
-        renamed = False
-        if log_date.hour == 0 and log_date.minute == 0 and log_date.second == 0:
-            print("Renaming log file")
-            log_msg = ': '.join(
-                [
-                    str(log_date_formatted),
-                    "Renaming log file"
-                ]
-            )
-            shutil.copyfile(log_file, log_file + "." + datetime.now().strftime(log_date_format))
-            renamed = True
-
-        if renamed:
-            log_fp = open(log_file, mode='w')
-            print("Renamed log file", file=log_fp)
-        else:
-            log_fp = open(log_file, mode='a')
-        log_msg = ': '.join(
-            [
-                str(log_date_formatted),
-                msg
-            ]
-        )
-
-        print(log_msg, file=log_fp)
-        if not silent:
-            print(log_msg)
-        log_fp.close()
-    except:
-        print_json(msg)
-        raise
\ No newline at end of file
+    config = ConfigHandler()
+    log_date_formatted = datetime.now().strftime(config.variables['LOG_DATE_FORMAT'])
+    get_log_sink(config.log_filepath).write(': '.join([str(log_date_formatted), msg]), silent=silent)
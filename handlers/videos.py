@@ -0,0 +1,136 @@
+from handlers.utilities import ConfigHandler
+from datetime import datetime, timedelta
+import re
+import sqlite3
+import threading
+
+PAGE_SIZE = 50
+DURATION_PATTERN = re.compile(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+
+
+def duration_seconds(duration):
+    match = DURATION_PATTERN.match(duration)
+    if match is None:
+        return 0
+    days, hours, minutes, seconds = [int(value) if value else 0 for value in match.groups()]
+
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def pages(video_ids, size=PAGE_SIZE):
+    unique_ids = list(dict.fromkeys(video_ids))
+
+    return [unique_ids[i:i + size] for i in range(0, len(unique_ids), size)]
+
+
+class VideoCache:
+    def __init__(self):
+        config = ConfigHandler()
+        self.filepath = config.video_cache_filepath
+        self.ttl = timedelta(hours=config.variables['VIDEO_CACHE_TTL_HOURS'])
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filepath, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS videos ("
+            "video_id TEXT PRIMARY KEY, "
+            "title TEXT, "
+            "channel_id TEXT, "
+            "channel_title TEXT, "
+            "published_at TEXT, "
+            "duration TEXT, "
+            "duration_seconds INTEGER, "
+            "live_broadcast_content TEXT, "
+            "fetched_at TEXT)"
+        )
+        self.connection.commit()
+
+    def get_many(self, video_ids):
+        # Rows past their TTL, and live or upcoming videos whose duration is not final, are misses
+        oldest = (datetime.now() - self.ttl).isoformat()
+        found = {}
+        for page in pages(video_ids, size=500):
+            placeholders = ",".join("?" * len(page))
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT video_id, title, channel_id, channel_title, published_at, duration, "
+                    "live_broadcast_content FROM videos WHERE video_id IN (%s) AND fetched_at > ? "
+                    "AND live_broadcast_content = 'none'" % placeholders,
+                    page + [oldest]
+                ).fetchall()
+            for row in rows:
+                found[row[0]] = {
+                    'id': row[0],
+                    'snippet': {
+                        'title': row[1],
+                        'channelId': row[2],
+                        'channelTitle': row[3],
+                        'publishedAt': row[4],
+                        'liveBroadcastContent': row[6]
+                    },
+                    'contentDetails': {
+                        'duration': row[5]
+                    }
+                }
+
+        return found
+
+    def put_many(self, videos):
+        fetched_at = datetime.now().isoformat()
+        rows = []
+        for video in videos:
+            duration = video['contentDetails']['duration'] if 'contentDetails' in video else 'P0D'
+            rows.append((
+                video['id'],
+                video['snippet']['title'],
+                video['snippet']['channelId'],
+                video['snippet']['channelTitle'],
+                video['snippet']['publishedAt'],
+                duration,
+                duration_seconds(duration),
+                video['snippet']['liveBroadcastContent'] if 'liveBroadcastContent' in video['snippet'] else 'none',
+                fetched_at
+            ))
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def invalidate(self, video_ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM videos WHERE video_id = ?", [(i,) for i in video_ids])
+            self.connection.commit()
+
+    def lookup(self, video_ids, fetch_page, map_pages=map):
+        # Read through the cache; fetch_page(ids) returns API video resources for up to 50 IDs
+        found = self.get_many(video_ids)
+        missing = [vid_id for vid_id in video_ids if vid_id not in found]
+        fetched = []
+        for items in map_pages(fetch_page, pages(missing)):
+            fetched += items
+        self.store(missing, fetched, found)
+
+        return found
+
+    def store(self, requested_ids, items, found):
+        self.put_many(items)
+        for video in items:
+            found[video['id']] = video
+
+        # Deleted or private videos come back empty; drop anything stale we held for them
+        gone = [vid_id for vid_id in requested_ids if vid_id not in found]
+        if len(gone) > 0:
+            self.invalidate(gone)
+
+        return found
+
+
+video_cache = None
+video_cache_lock = threading.Lock()
+
+
+def get_video_cache():
+    global video_cache
+    with video_cache_lock:
+        if video_cache is None:
+            video_cache = VideoCache()
+    return video_cache
@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+from handlers.utilities import Logger
+import threading
+
+logger = Logger()
+
+
+class TaskPool:
+    def __init__(self, workers, name="worker"):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        # Tasks may submit follow-up tasks; the counter is raised before the parent
+        # finishes, so wait() only returns once the whole chain is done.
+        with self.condition:
+            self.pending += 1
+        self.executor.submit(self.run_task, fn, *args, **kwargs)
+
+    def map(self, fn, items):
+        # Returns fn(item) for each item in order, raising the first error; it waits only on
+        # these tasks, so callers can share a pool that is also running other work
+        futures = [self.executor.submit(fn, item) for item in items]
+
+        return [future.result() for future in futures]
+
+    def run_task(self, fn, *args, **kwargs):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logger.write("Task failed: %s: %s" % (getattr(fn, '__qualname__', fn), repr(e)))
+            with self.condition:
+                self.errors.append(e)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.condition.notify_all()
+
+    def wait(self):
+        # Returns the errors since the last wait, so a shared pool reports each batch on its own
+        with self.condition:
+            while self.pending > 0:
+                self.condition.wait()
+            errors = self.errors
+            self.errors = []
+
+        return errors
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(name, workers):
+    # Pools live as long as the process, so their threads and the API clients they hold
+    # are reused by every scan a resident process runs
+    with pools_lock:
+        if name not in pools:
+            pools[name] = TaskPool(workers, name=name)
+        return pools[name]
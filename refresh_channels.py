@@ -48,4 +48,6 @@ def fetch(args):
     subs.write()
     ranks.write()
 
-main()
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
 from datetime import datetime, timedelta
+from handlers import metrics, quota
+from handlers.utilities import ConfigHandler, get_log_sink, load_json
 import os
 import json
 
-ERROR_CODES = [403, 404, 408, 500, 502, 503, 504]
-
 
 def update_global_vars(initialize=False):
 
@@ -49,8 +49,7 @@ def update_global_vars(initialize=False):
     global FILLER_INDEX
 
     config_file = 'config.json'
-    config_fp = open(config_file)
-    config = json.load(config_fp)
+    config = ConfigHandler().variables
 
 
     SCOPES = config['SCOPES']
@@ -71,18 +70,12 @@ def update_global_vars(initialize=False):
     PRIVATE_VIDEOS_FILE = '/'.join([HOME_DIR, config['PRIVATE_VIDEOS_FILE']])
     LOG_FILE = '/'.join([LOG_DIR, 'current.log'])
     if initialize:
-        if os.path.isfile(LOG_FILE):
-            print("Renaming log file")
-            os.rename(LOG_FILE, LOG_FILE + "." + datetime.now().strftime(LOG_DATE_FORMAT))
-        else:
-            log("Creating new log file")
-            open(LOG_FILE, mode='w')
+        print("Renaming log file")
+        get_log_sink(LOG_FILE).rotate()
     LAST_TIER = config['LAST_TIER']
 
-    ranks_fp = open(RANKS_FILE)
-    ranks = json.load(ranks_fp)
+    ranks = load_json(RANKS_FILE)
     filters = ranks['filters']
-    ranks_fp.close()
     if type == 'channels':
         filtered_channels = []
         for channel in filters['channels']:
@@ -111,41 +104,8 @@ def update_global_vars(initialize=False):
 
 
 def log(msg, silent=False):
-    try:
-        log_date = datetime.now()
-        log_date_formatted = log_date.strftime(YOUTUBE_DATE_FORMAT)
-        # renamed = False
-        # if log_date.hour == 0 and log_date.minute == 0 and log_date.second == 0:
-        #     print("Renaming log file")
-        #     update_global_vars(initialize=True)
-        #     log_msg = ': '.join(
-        #         [
-        #             str(log_date_formatted),
-        #             "Renaming log file"
-        #         ]
-        #     )
-        #     shutil.copyfile(LOG_FILE, LOG_FILE + "." + datetime.now().strftime(LOG_DATE_FORMAT))
-        #     renamed = True
-        #
-        # if renamed:
-        #     log_fp = open(LOG_FILE, mode='w')
-        #     print("Renamed log file", file=log_fp)
-        # else:
-        log_fp = open(LOG_FILE, mode='a')
-        log_msg = ': '.join(
-            [
-                str(log_date_formatted),
-                msg
-            ]
-        )
-
-        print(log_msg.encode('utf-8'), file=log_fp)
-        if not silent:
-            print(log_msg.encode('utf-8'))
-        log_fp.close()
-    except:
-        print_json(msg)
-        raise
+    log_date_formatted = datetime.now().strftime(YOUTUBE_DATE_FORMAT)
+    get_log_sink(LOG_FILE).write(': '.join([str(log_date_formatted), msg]), silent=silent)
 
 
 def print_json(obj, fp=None):
@@ -233,29 +193,38 @@ def merge_sort_split_v2(
     ids = subscriptions['details']
 
     log("Combining playlists")
+    metrics.set_phase("combine")
 
-    combined = []
-
+    # Listed concurrently, then merged in this order so the combined positions match a serial fetch
+    sources = []
     if import_queue:
-        current_queue = get_playlist_items(client, autolist_id=QUEUE_ID, playlist_title='queue')
-        combined = combined + current_queue
+        sources.append((QUEUE_ID, 'queue', False))
     if sort_current:
-        current_autolist = get_playlist_items(client, autolist_id=WATCH_LATER_ID, playlist_title='autolist')
-        current_backlog = get_playlist_items(client, autolist_id=BACKLOG_ID, playlist_title='backlog')
-        combined = combined + current_autolist + current_backlog
+        sources.append((WATCH_LATER_ID, 'autolist', False))
+        sources.append((BACKLOG_ID, 'backlog', False))
     if sort_f1:
-        current_f1playlist = get_playlist_items(client, autolist_id=F1_PLAYLIST_ID, playlist_title='F1 playlist')
-        combined = combined + current_f1playlist
+        sources.append((F1_PLAYLIST_ID, 'F1 playlist', False))
     if sort_secondary:
-        current_secondary = []
         for tier in TIER_PLAYLISTS:
-            current_secondary = current_secondary + get_playlist_items(client, autolist_id=TIER_PLAYLISTS[tier],
-                                                                       playlist_title="%s secondary playlist" % tier)
-        log("Total secondary items: %s" % len(current_secondary))
-        combined = combined + current_secondary
+            sources.append((TIER_PLAYLISTS[tier], "%s secondary playlist" % tier, True))
     if sort_xl:
-        current_xl = get_playlist_items(client, autolist_id=XL_ID, playlist_title='xl playlist')
-        combined = combined + current_xl
+        sources.append((XL_ID, 'xl playlist', False))
+
+    combined = []
+    current_secondary = []
+    for source, items in zip(sources, get_playlists_items(sources)):
+        combined.extend(items)
+        if source[2]:
+            current_secondary.extend(items)
+    if sort_secondary:
+        log("Total secondary items: %s" % len(current_secondary))
+
+    # Current order of every fetched playlist, used to plan minimal reorders
+    playlist_order = {}
+    for vid in combined:
+        if vid['snippet']['playlistId'] not in playlist_order:
+            playlist_order[vid['snippet']['playlistId']] = []
+        playlist_order[vid['snippet']['playlistId']].append(vid['id'])
 
     # max_length = AUTOLIST_MAX_LENGTH + len(current_xl)
     # combine_f1 = True if len(combined) < max_length else False
@@ -299,40 +268,13 @@ def merge_sort_split_v2(
 
     # Fetching data on all videos in combined list
     log("Getting detailed info on each video")
+    metrics.set_phase("details")
+    video_details = get_video_details([vid['contentDetails']['videoId'] for vid in combined])
     for vid in combined:
         vid_id = vid['contentDetails']['videoId']
-        request = client.videos().list(
-            part='snippet,contentDetails',
-            id=vid_id
-        )
-        response = execute(request)
-        video = response['items'][0] if len(response['items']) > 0 else None
-        try:
-            duration = video['contentDetails']['duration'].replace('P', '').replace('T', '')
-        except:
-            print_json(video)
-        days = 0
-        hours = 0
-        minutes = 0
-        seconds = 0
-        if 'D' in duration:
-            days_list = duration.split('D')
-            hours = days * 24
-            duration = days_list[1]
-        if 'H' in duration:
-            hours_list = duration.split('H')
-            hours = hours + int(hours_list[0])
-            minutes = hours * 60
-            duration = hours_list[1]
-        if 'M' in duration:
-            minutes_list = duration.split('M')
-            minutes = minutes + int(minutes_list[0])
-            seconds = minutes * 60
-            duration = minutes_list[1]
-        if 'S' in duration:
-            seconds_list = duration.split('S')
-            seconds = seconds + int(seconds_list[0])
+        video = video_details[vid_id] if vid_id in video_details else None
         if video is not None:
+            duration = parse_duration(video['contentDetails']['duration'])
             vid_details = {
                 'channelId': video['snippet']['channelId'],
                 'channelTitle': video['snippet']['channelTitle'],
@@ -342,11 +284,7 @@ def merge_sort_split_v2(
                 'sourcePlaylistId': vid['snippet']['playlistId'],
                 'playlistItemId': vid['id'],
                 'position': vid['snippet']['position'],
-                'duration': {
-                    'hours': hours,
-                    'minutes': minutes,
-                    'seconds': seconds
-                }
+                'duration': duration
             }
             videos.append(vid_details)
         else:
@@ -541,7 +479,8 @@ def merge_sort_split_v2(
             'id': XL_ID,
             'autolist': xl_combined,
             'results': [],
-            'deleted': []
+            'deleted': [],
+            'priority': quota.LOW
         }
     ]
 
@@ -556,11 +495,13 @@ def merge_sort_split_v2(
                 'id': TIER_PLAYLISTS[str(tier)],
                 'autolist': secondary_playlists[tier],
                 'results': [],
-                'deleted': []
+                'deleted': [],
+                'priority': quota.LOW
             }
         )
 
     log("Placing all videos")
+    metrics.set_phase("place")
     final_response = {}
     for playlist in playlists:
         if playlist['sort']:
@@ -571,7 +512,9 @@ def merge_sort_split_v2(
                 autolist=data['autolist'],
                 playlist_label=playlist['name'],
                 target_playlist_id=data['id'],
-                already_added_ids=already_added_ids
+                already_added_ids=already_added_ids,
+                playlist_order=playlist_order,
+                priority=playlist['priority'] if 'priority' in playlist else quota.NORMAL
             )
 
             final_response[playlist['name']]['results'] = response['results']
@@ -582,50 +525,92 @@ def merge_sort_split_v2(
     return final_response
 
 
-def add_to_target_autolist(autolist, playlist_label, target_playlist_id, already_added_ids):
+def add_to_target_autolist(autolist, playlist_label, target_playlist_id, already_added_ids, playlist_order=None,
+                           priority=None):
+    from handlers.mutations import Mutation, MutationExecutor, Skipped
+    from handlers import reorder
+    import googleapiclient.errors
+
     # Load the credentials from the session.
     client = get_client()
+    if playlist_order is None:
+        playlist_order = {}
 
     results = []
     deleted = []
-    pos = 0
+    desired = []
+    removals = []
+    planned = []
     if len(autolist) > 0:
         msg = " ".join(["There are", str(len(autolist)), "items in the", playlist_label, "playlist"])
         log(msg)
         for item in autolist:
-            msg_list = []
-            vid_title = item['videoTitle']
-            channel_title = item['channelTitle']
             if item['videoId'] not in already_added_ids:
-                label = ": ".join([channel_title, vid_title])
-                if item['sourcePlaylistId'] == target_playlist_id:
-                    msg_list.append("\tRetaining position:")
-                else:
-                    try:
-                        msg_list = msg_list + ["\tMoving into the", playlist_label, "playlist in position ", str(pos), ":"]
-                        body = {
-                            'snippet.playlistId': target_playlist_id,
-                            'snippet.resourceId.kind': 'youtube#video',
-                            'snippet.resourceId.videoId': item['videoId'],
-                            'snippet.position': pos
-                        }
-                        if not TEST:
-                            response = playlist_items_insert(client, body, part='snippet')
-                            body['id'] = response['id']
-                            playlist_items_delete(client,id=item['playlistItemId'])
-                    except:
-                        print_json(item)
-                        raise
-                pos += 1
-                results.append(label)
+                desired.append(item)
+                results.append(": ".join([item['channelTitle'], item['videoTitle']]))
                 already_added_ids.append(item['videoId'])
-                msg_list.append(label)
             else:
-                msg_list = msg_list + ["\tDeleting:", vid_title]
+                log("\tDeleting: %s" % item['videoTitle'])
                 deleted.append(item)
-                if not TEST:
-                    playlist_items_delete(client, id=item['playlistItemId'])
-            log(" ".join(msg_list))
+                request = client.playlistItems().delete(id=item['playlistItemId'])
+                removals.append(Mutation('delete', request, item))
+
+        deleted_ids = set(item['playlistItemId'] for item in deleted)
+        current_order = [i for i in playlist_order.get(target_playlist_id, []) if i not in deleted_ids]
+        planned = plan_placements(client, current_order, desired, target_playlist_id, playlist_label)
+        log("%i of %i items in the %s playlist need to move" % (len(planned), len(desired), playlist_label))
+
+    if not TEST:
+        executor = MutationExecutor(client, execute, priority)
+        executor.run_batched(removals)
+        placements = []
+        while True:
+            executor.run_ordered(planned)
+            sent = [mutation for mutation in planned if not isinstance(mutation.error, Skipped)]
+            placements += sent
+            if len(sent) == len(planned):
+                break
+
+            # Later positions assumed the failed placement landed; plan the rest again from a fresh
+            # listing, leaving out the failed item, and using the new IDs of the items inserted so far
+            failed = sent[-1]
+            log("\tPlanning the rest of the %s playlist again without %s" % (playlist_label, failed.item['videoTitle']))
+            try:
+                listing = get_playlist_items(client, target_playlist_id, playlist_label)
+            except (googleapiclient.errors.HttpError, quota.QuotaDeferred, quota.QuotaExhausted) as e:
+                log("\tFailed to list the %s playlist, leaving the rest unplaced: %s" % (playlist_label, e))
+                break
+            current_order = [vid['id'] for vid in listing]
+            inserted = dict((mutation.item['videoId'], mutation.response['id']) for mutation in placements
+                            if mutation.kind == reorder.INSERT and mutation.succeeded())
+            remaining = []
+            for item in desired:
+                if item['videoId'] == failed.item['videoId']:
+                    continue
+                if item['videoId'] in inserted:
+                    if inserted[item['videoId']] not in current_order:
+                        continue
+                    item = dict(item, sourcePlaylistId=target_playlist_id, playlistItemId=inserted[item['videoId']])
+                remaining.append(item)
+            desired = remaining
+            planned = plan_placements(client, current_order, desired, target_playlist_id, playlist_label)
+
+        # Only remove a moved video from its old playlist once the insert landed
+        moves = []
+        for mutation in placements:
+            if mutation.kind == reorder.INSERT and mutation.succeeded():
+                request = client.playlistItems().delete(id=mutation.item['playlistItemId'])
+                moves.append(Mutation('delete', request, mutation.item))
+        executor.run_batched(moves)
+
+        for mutation in removals + moves:
+            source_order = playlist_order.get(mutation.item['sourcePlaylistId'], [])
+            if mutation.succeeded() and mutation.item['playlistItemId'] in source_order:
+                source_order.remove(mutation.item['playlistItemId'])
+
+        for mutation in removals + placements + moves:
+            if not mutation.succeeded():
+                log("\tFailed to %s %s: %s" % (mutation.kind, mutation.item['videoTitle'], mutation.error))
 
     return {
         'results': results,
@@ -634,6 +619,40 @@ def add_to_target_autolist(autolist, playlist_label, target_playlist_id, already
     }
 
 
+def plan_placements(client, current_order, desired, target_playlist_id, playlist_label):
+    from handlers.mutations import Mutation
+    from handlers import reorder
+
+    placements = []
+    for step in reorder.plan_reorder(current_order, desired, target_playlist_id):
+        item = step['item']
+        label = ": ".join([item['channelTitle'], item['videoTitle']])
+        if step['action'] == reorder.KEEP:
+            log("\tRetaining position: %s" % label)
+            continue
+
+        body = {
+            'snippet': {
+                'playlistId': target_playlist_id,
+                'resourceId': {
+                    'kind': 'youtube#video',
+                    'videoId': item['videoId']
+                },
+                'position': step['position']
+            }
+        }
+        if step['action'] == reorder.UPDATE:
+            log("\tMoving within the %s playlist to position %i: %s" % (playlist_label, step['position'], label))
+            body['id'] = item['playlistItemId']
+            request = client.playlistItems().update(part='snippet', body=body)
+        else:
+            log("\tMoving into the %s playlist in position %i: %s" % (playlist_label, step['position'], label))
+            request = client.playlistItems().insert(part='snippet', body=body)
+        placements.append(Mutation(step['action'], request, item))
+
+    return placements
+
+
 def playlist_items_insert(client, properties, **kwargs):
     # See full sample for function
     resource = build_resource(properties)
@@ -670,7 +689,6 @@ def get_playlist_items(client, autolist_id, playlist_title='autolist'):
     request = client.playlistItems().list(playlistId=autolist_id, part='contentDetails', maxResults=50)
     vids = []
     page = 1
-    print("Fetching " + playlist_title, end=": ")
     position = 0
     while request is not None:
         response = execute(request)
@@ -682,15 +700,79 @@ def get_playlist_items(client, autolist_id, playlist_title='autolist'):
             item['snippet']['playlistId'] = autolist_id
             item['snippet']['position'] = position
             position += 1
-            vids.append(item)
+        vids.extend(items)
 
         request = client.playlistItems().list(playlistId=autolist_id, part='contentDetails', maxResults=50, pageToken=next_page_token) if next_page_token is not None else None
 
         page += 1
-    print(str(len(vids)) + " items found")
+    print("Fetching %s: %i items found" % (playlist_title, len(vids)))
     return vids
 
 
+def get_pool():
+    from handlers import workers
+
+    # The scanner's pool: its threads outlive each call, and in the daemon each job, so the
+    # API client every worker thread builds is reused rather than rebuilt
+    return workers.get_pool("scan", config['SCAN_WORKERS'])
+
+
+def get_playlists_items(sources):
+    # Pages of one playlist follow each other's tokens, so the concurrency is across playlists.
+    # Results come back in the order of sources.
+    def fetch_playlist(source):
+        # httplib2 connections are not thread-safe, so each worker uses its own client
+        return get_playlist_items(get_client(), autolist_id=source[0], playlist_title=source[1])
+
+    return get_pool().map(fetch_playlist, sources)
+
+
+def get_video_details(video_ids, part='snippet,contentDetails'):
+    from handlers import videos
+
+    def fetch_page(page):
+        # httplib2 connections are not thread-safe, so each worker uses its own client
+        request = get_client().videos().list(part=part, id=",".join(page))
+        return execute(request)['items']
+
+    def map_pages(fetch, pages):
+        log("Fetching details for %i uncached videos in %i requests" % (sum(len(p) for p in pages), len(pages)))
+        return get_pool().map(fetch, pages)
+
+    return videos.get_video_cache().lookup(video_ids, fetch_page, map_pages=map_pages)
+
+
+def parse_duration(duration):
+    duration = duration.replace('P', '').replace('T', '')
+    days = 0
+    hours = 0
+    minutes = 0
+    seconds = 0
+    if 'D' in duration:
+        days_list = duration.split('D')
+        hours = days * 24
+        duration = days_list[1]
+    if 'H' in duration:
+        hours_list = duration.split('H')
+        hours = hours + int(hours_list[0])
+        minutes = hours * 60
+        duration = hours_list[1]
+    if 'M' in duration:
+        minutes_list = duration.split('M')
+        minutes = minutes + int(minutes_list[0])
+        seconds = minutes * 60
+        duration = minutes_list[1]
+    if 'S' in duration:
+        seconds_list = duration.split('S')
+        seconds = seconds + int(seconds_list[0])
+
+    return {
+        'hours': hours,
+        'minutes': minutes,
+        'seconds': seconds
+    }
+
+
 def build_resource(properties):
   resource = {}
   for p in properties:
@@ -740,17 +822,24 @@ def remove_empty_kwargs(**kwargs):
   return good_kwargs
 
 
-def execute(request_object):
-    response = request_object.execute()
+def execute(request_object, priority=None):
+    from handlers import execution
+
+    response = execution.execute(request_object, quota.NORMAL if priority is None else priority)
     return response
 
 
-kwargs = {
-    "sort_current": True,
-    "sort_f1": True,
-    "import_queue": True,
-    "sort_secondary": False,
-    "sort_xl": False,
-    "sort": False
-}
-merge_sort_split_v2(**kwargs)
\ No newline at end of file
+def main():
+    kwargs = {
+        "sort_current": True,
+        "sort_f1": True,
+        "import_queue": True,
+        "sort_secondary": False,
+        "sort_xl": False,
+        "sort": False
+    }
+    merge_sort_split_v2(**kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ def main():
         part="snippet,contentDetails,statistics",
         id="UC_x5XG1OV2P6uZZ5FSM9Ttw"
     )
-    response = request.execute()
+    response = handler.execute(request)
 
     print(response)
 